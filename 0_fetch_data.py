@@ -1,42 +1,162 @@
 # %%
+"""
+fetch_data.py
+Converts the monthly .xls files in data/ into long-format CSVs in csv/.
+
+Files are converted in parallel on a process pool. The number of workers defaults
+to the CPU count and can be set with --workers N or the CREFIA_WORKERS variable
+(a positive whole number; anything else is a usage error).
+
+Every sheet is fingerprinted and matched to the layout crefia_label.csv was written
+for (crefia_layout.py) before it is converted; sheets that can't be matched are
+rejected and the script exits with status 1 after converting the others.
+
+A file is only converted when its content, crefia_label.csv or the converter
+changed since its CSV was written (csv/convert_manifest.json, see crefia_convert.py);
+a routine monthly run converts just the new month. An existing CSV that already
+holds the same data is kept, so a fresh clone (no manifest yet) converts every
+file once but rewrites none of the tracked CSVs. The CSVs written are handed to
+1_to_sqlite3.py through csv/changed.json.
+"""
+
 import os
+import sys
+import time
+import argparse
 import pandas as pd
+from concurrent.futures import Future, ProcessPoolExecutor, as_completed
+
+from crefia_convert import (add_changed, convert_xls, init_worker, is_converted, load_manifest,
+                            period_from_filename, record_conversion, save_manifest, source_sha256)
+from crefia_layout import (LayoutError, cache_layout, cached_layout, crefia_label_path, file_sha256,
+                           load_cache, load_reference, save_cache)
+from crefia_profile import call_collecting, merge, start_report
 
 data_dir = 'data'
 csv_dir = 'csv'
 os.makedirs(csv_dir, exist_ok=True)
 
-# Load crefia_label.csv (now in root directory)
-crefia_label_path = 'crefia_label.csv'
-df_label = pd.read_csv(crefia_label_path)
-
-# List all .xls files in the data directory
-xls_files = [f for f in os.listdir(data_dir) if f.endswith('.xls')]
-
-for xls_file in xls_files:
-    xls_path = os.path.join(data_dir, xls_file)
-    # Extract YYYYMM from the xls filename (assuming it's after the last underscore)
-    label = xls_file.split('_')[-1].replace('.xls', '')
-    crefia_csv_file = f"crefia_{label}.csv"
-    crefia_csv_path = os.path.join(csv_dir, crefia_csv_file)
-
-    # Only convert if crefia_YYYYMM.csv does not already exist
-    if not os.path.exists(crefia_csv_path):
-        df = pd.read_excel(xls_path)
-        
-        # Replace first five columns with crefia_label.csv columns using pd.concat
-        df = pd.concat([df_label, df.iloc[:, 5:].apply(pd.to_numeric, errors='coerce')], axis=1)
-
-        # Add 기준년월 column
-        df.insert(0, '기준년월', label)
-
-        # Melt the DataFrame so that all columns after the first five become rows
-        df = df.melt(
-            id_vars=['기준년월','신용체크구분','개인법인구분','대분류','중분류','소분류'],
-            var_name='구분',
-            value_name='value'
-        )
-        df.to_csv(crefia_csv_path, index=False)
-        print(f"Converted {xls_file} to {crefia_csv_file} (first five columns replaced with crefia_label.csv)")
-    else:
-        print(f"{crefia_csv_file} already exists, skipping.")
\ No newline at end of file
+
+def _run_now(fn, *args):
+    """Run fn in this process, returning a completed Future (the single-worker path)."""
+    future = Future()
+    try:
+        future.set_result(fn(*args))
+    except Exception as e:
+        future.set_exception(e)
+    return future
+
+
+def positive_int(value):
+    try:
+        number = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'{value!r} is not a whole number')
+    if number < 1:
+        raise argparse.ArgumentTypeError(f'{value!r} is not a positive number')
+    return number
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Convert the monthly .xls files in data/ into CSVs in csv/.')
+    # A string default goes through `type` too, so a bad CREFIA_WORKERS is reported the same way
+    parser.add_argument('--workers', type=positive_int, default=os.environ.get('CREFIA_WORKERS'),
+                        help='worker processes (default: CREFIA_WORKERS, then the CPU count)')
+    return parser.parse_args(argv)
+
+
+def get_worker_count(workers=None):
+    """Worker processes to use: --workers N, then CREFIA_WORKERS (both in `workers`), then the CPU count."""
+    return workers if workers is not None else max(1, os.cpu_count() or 1)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+
+    # Timing report in profile/fetch.json when CREFIA_PROFILE=1
+    start_report('fetch')
+
+    # Load crefia_label.csv (now in root directory)
+    df_label = pd.read_csv(crefia_label_path)
+
+    # The sheet layout crefia_label.csv describes, and the layouts already seen per file
+    reference = load_reference()
+    label_sha256 = file_sha256(crefia_label_path)
+    if reference['label_sha256'] != label_sha256:
+        sys.exit(f'{crefia_label_path} changed since crefia_layout.json was recorded; '
+                 f'run python crefia_layout.py with an .xls file that matches it')
+    cache = load_cache(reference)
+    # What each existing CSV was converted from
+    manifest = load_manifest()
+
+    # List all .xls files in the data directory
+    xls_files = sorted(f for f in os.listdir(data_dir) if f.endswith('.xls'))
+
+    jobs, up_to_date = [], 0
+    for xls_file in xls_files:
+        xls_path = os.path.join(data_dir, xls_file)
+        crefia_csv_path = os.path.join(csv_dir, f"crefia_{period_from_filename(xls_file)}.csv")
+        xls_sha256 = source_sha256(manifest, xls_path)
+
+        # Only convert new or revised files, or all of them after a label or converter change
+        if is_converted(manifest, xls_path, xls_sha256, label_sha256, crefia_csv_path):
+            up_to_date += 1
+            # Same content: only refresh the size and modification time (e.g. a re-downloaded file)
+            record_conversion(manifest, xls_path, xls_sha256, label_sha256, crefia_csv_path)
+        else:
+            jobs.append((xls_path, crefia_csv_path, xls_sha256, cached_layout(cache, xls_path)))
+    print(f"{up_to_date} file(s) up to date, {len(jobs)} to convert.")
+
+    timings, rejected, converted = [], [], []
+    if jobs:
+        workers = min(get_worker_count(args.workers), len(jobs))
+        start = time.perf_counter()
+        # The label frame and layout are sent once per worker through the initializer, not once per file
+        init_worker(df_label, reference)
+        pool = (ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(df_label, reference))
+                if workers > 1 else None)
+        try:
+            submit = pool.submit if pool else _run_now
+            # Each job hands back its timing spans along with its result
+            futures = {submit(call_collecting, convert_xls, xls_path, csv_path, None, layout):
+                       (xls_path, csv_path, xls_sha256)
+                       for xls_path, csv_path, xls_sha256, layout in jobs}
+            for future in as_completed(futures):
+                xls_path, csv_path, xls_sha256 = futures[future]
+                try:
+                    (name, rows, seconds, (digest, row_map), written), spans = future.result()
+                    merge(spans)
+                except LayoutError as e:
+                    rejected.append(str(e))
+                    print(f"Rejected {e}")
+                    continue
+                timings.append((name, rows, seconds))
+                cache_layout(cache, xls_path, digest, row_map)
+                record_conversion(manifest, xls_path, xls_sha256, label_sha256, csv_path)
+                if not written:
+                    print(f"Converted {name}: {os.path.basename(csv_path)} already holds the same data, kept")
+                    continue
+                print(f"Converted {name} (first five columns replaced with crefia_label.csv"
+                      f"{', rows remapped' if row_map is not None else ''})")
+                converted.append(os.path.basename(csv_path))
+        finally:
+            if pool:
+                pool.shutdown()
+        save_cache(cache)
+        elapsed = time.perf_counter() - start
+
+        # Per-file timing summary
+        if timings:
+            print(f"\n{'file':<40} {'rows':>8} {'seconds':>8}")
+            for xls_file, rows, seconds in sorted(timings):
+                print(f"{xls_file:<40} {rows:>8} {seconds:>8.2f}")
+        print(f"Converted {len(timings)} file(s) with {workers} worker(s) in {elapsed:.2f}s "
+              f"(sum of per-file time {sum(t[2] for t in timings):.2f}s)")
+
+    save_manifest(manifest)
+    if converted:
+        # Picked up by the next 1_to_sqlite3.py run
+        add_changed(converted)
+
+    if rejected:
+        sys.exit(f"{len(rejected)} file(s) rejected: layout doesn't match crefia_label.csv\n" + '\n'.join(rejected))
@@ -2,38 +2,455 @@
 """
 preprocess_data.py
 Handles merging, cleaning, transforming, and saving the processed data to the master table.
+
+Loading is incremental: every ingested crefia_YYYYMM.csv is recorded in a manifest
+table (name, size, content hash), and only new or changed months are replaced.
+All changes are applied inside a single transaction, so readers see either the
+previous or the new state of the data, never a partial one.
+Pass --full to reload every CSV regardless of the manifest; a full reload is
+built in a separate file and swapped in atomically (crefia_db.swap_in).
+Incremental loads run in place with WAL journaling, so the dashboard keeps
+reading the last committed state while a load is running. When 0_fetch_data.py
+left a list of the months it converted (csv/changed.json), only those files and
+files that are new or changed in size are hashed.
+
+CSVs are streamed in chunks of CREFIA_INGEST_CHUNK_ROWS rows (default 100000)
+and inserted with executemany, so memory depends on the chunk size, not on the
+history. Full rebuilds write the scratch file with journaling and fsync off
+(crefia_db.connect_for_build) and create the period index after the load.
+
+Storage is a star schema:
+  dim_metric  one row per label row of crefia_label.csv (metric_id)
+  dim_issuer  one row per card issuer / 구분 column (issuer_id)
+  fact_value  (period, metric_id, issuer_id, value), keyed on (metric_id, issuer_id, period)
+master_table is a view over the three tables with the original wide text columns,
+so existing queries keep working unchanged.
+
+Every ingest refreshes the materialized dashboard metrics (summary_metric) for the
+changed months, recomputes the derived metrics (growth, churn, shares; see
+crefia_derived.py) and bumps the single-row data_version table in the same transaction;
+the dashboard keys its caches on that stamp.
+
+Before anything is committed the loaded months are checked (crefia_checks.py):
+issuers against the published 합계, subtotals against their detail rows and
+month-over-month jumps against each series' history. A failed blocking check
+rolls the load back (a --full rebuild is not swapped in) and exits with status 1;
+the findings are in ingest_checks.json. --no-checks skips the checks.
+
+The loaded months are also written to the Parquet dataset in parquet/ (see crefia_parquet.py)
+once the transaction has committed. ingest_manifest.parquet_hash records the
+content hash each file's partitions were written from, so every run rewrites
+exactly the partitions that are missing or stale, e.g. after a fresh clone or
+an interrupted run, without reloading SQLite. Finally the dashboard's charts
+and tables are pre-rendered to export/ for the new data version (see crefia_export.py).
 """
 
 import os
+import shutil
+import hashlib
+import argparse
 import pandas as pd
 import sqlite3
 
+from crefia_checks import REPORT_PATH, ConsistencyError, check_loaded, summary_lines, write_report
+from crefia_convert import clear_changed, read_changed
+from crefia_db import checkpoint, connect_for_build, connect_for_ingest, swap_in
+from crefia_derived import refresh_derived
+from crefia_export import export_dir, export_static
+from crefia_metrics import SUMMARY_METRICS, create_summary_table, read_data_version, refresh_summary
+from crefia_parquet import parquet_dir, partition_exists, write_months
+from crefia_profile import profiled, span, start_report
+
 csv_folder = 'csv'
 db_filename = 'master.db'
 table_name = 'master_table'
+manifest_table = 'ingest_manifest'
+version_table = 'data_version'
+crefia_label_path = 'crefia_label.csv'
+metric_columns = ['신용체크구분', '개인법인구분', '대분류', '중분류', '소분류']
+csv_dtypes = {'기준년월': str, **{col: str for col in metric_columns}, '구분': str}
+
+# Rows read and inserted at a time
+chunk_rows = int(os.environ.get('CREFIA_INGEST_CHUNK_ROWS', 100_000))
+
+
+def parse_args(argv=None):
+    # No abbreviations: a mistyped flag is a usage error, not a different load
+    parser = argparse.ArgumentParser(description='Load the monthly CSVs in csv/ into master.db.', allow_abbrev=False)
+    parser.add_argument('--full', action='store_true',
+                        help='rebuild master.db from every CSV, regardless of the manifest')
+    parser.add_argument('--no-checks', dest='checks', action='store_false',
+                        help='skip the consistency checks of the loaded months (crefia_checks.py)')
+    return parser.parse_args(argv)
+
+
+def file_sha256(file_path, block_size=1 << 20):
+    """Return the hex SHA-256 digest of a file, read in blocks."""
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
 
-# Get all CSV files in the folder
-csv_files = [f for f in os.listdir(csv_folder) if f.endswith('.csv')]
 
-# Read and concatenate all CSV files into a single DataFrame
-df_list = []
-for file in csv_files:
-    file_path = os.path.join(csv_folder, file)
-    df = pd.read_csv(file_path)
+def normalize_month(df):
+    """Normalize the column types of a monthly CSV frame (or chunk)."""
     # Ensure 'value' column is numeric
     if 'value' in df.columns:
         df['value'] = pd.to_numeric(df['value'], errors='coerce')
-    # Ensure '기준년월' is string and formatted as YYYY-MM
+    # Ensure '기준년월' is string and formatted as YYYYMM
     if '기준년월' in df.columns:
         df['기준년월'] = df['기준년월'].astype(str).str.zfill(6)
+    return df
+
+
+def read_csv_chunks(file_path, chunksize=None):
+    """Yield one monthly CSV as normalized frames of at most chunksize rows."""
+    with pd.read_csv(file_path, dtype=csv_dtypes, chunksize=chunksize or chunk_rows) as reader:
+        while True:
+            # Parsing is timed per chunk, outside whatever the caller does with it
+            with span('read_csv') as s:
+                chunk = next(reader, None)
+                if chunk is None:
+                    break
+                chunk = normalize_month(chunk)
+                s.rows = len(chunk)
+            yield chunk
+
+
+def read_month_csv(file_path):
+    """Read one monthly CSV and normalize its column types."""
+    with span('read_csv') as s:
+        df = normalize_month(pd.read_csv(file_path, dtype=csv_dtypes))
+        s.rows = len(df)
+    return df
+
+
+def create_star_schema(conn):
+    """Create the dimension and fact tables and the master_table compatibility view."""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS dim_metric (
+            metric_id    INTEGER PRIMARY KEY,
+            신용체크구분  TEXT NOT NULL,
+            개인법인구분  TEXT NOT NULL,
+            대분류        TEXT NOT NULL,
+            중분류        TEXT NOT NULL,
+            소분류        TEXT NOT NULL,
+            UNIQUE (신용체크구분, 개인법인구분, 대분류, 중분류, 소분류)
+        )''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS dim_issuer (
+            issuer_id INTEGER PRIMARY KEY,
+            구분       TEXT NOT NULL UNIQUE
+        )''')
+    # The primary key doubles as the covering index for (metric, issuer, period) lookups
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS fact_value (
+            period    INTEGER NOT NULL,
+            metric_id INTEGER NOT NULL REFERENCES dim_metric (metric_id),
+            issuer_id INTEGER NOT NULL REFERENCES dim_issuer (issuer_id),
+            value     REAL,
+            PRIMARY KEY (metric_id, issuer_id, period)
+        ) WITHOUT ROWID''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_fact_value_period ON fact_value (period)')
+    conn.execute(f'''
+        CREATE VIEW IF NOT EXISTS "{table_name}" AS
+        SELECT CAST(f.period AS TEXT) AS 기준년월,
+               m.신용체크구분, m.개인법인구분, m.대분류, m.중분류, m.소분류,
+               i.구분, f.value
+          FROM fact_value f
+          JOIN dim_metric m ON m.metric_id = f.metric_id
+          JOIN dim_issuer i ON i.issuer_id = f.issuer_id''')
+
+    # Seed dim_metric in crefia_label.csv order so metric ids are stable across rebuilds
+    df_label = pd.read_csv(crefia_label_path)
+    conn.executemany(f'''
+        INSERT OR IGNORE INTO dim_metric ({', '.join(metric_columns)}) VALUES (?, ?, ?, ?, ?)''',
+        df_label[metric_columns].itertuples(index=False, name=None))
+
+
+def bump_version(conn):
+    """Mark the data as changed for the dashboard caches."""
+    conn.execute(f"UPDATE {version_table} SET version = version + 1, updated_at = datetime('now')")
+
+
+@profiled()
+def ensure_schema(conn):
+    """Create the star schema and manifest, migrating a legacy wide master_table if present."""
+    row = conn.execute('SELECT type FROM sqlite_master WHERE name = ?', (table_name,)).fetchone()
+    legacy = row is not None and row[0] == 'table'
+
+    with conn:
+        conn.execute('BEGIN IMMEDIATE')
+        if legacy:
+            conn.execute(f'ALTER TABLE "{table_name}" RENAME TO legacy_{table_name}')
+        create_star_schema(conn)
+        if legacy:
+            conn.execute(f'''
+                INSERT OR IGNORE INTO dim_metric ({', '.join(metric_columns)})
+                SELECT DISTINCT {', '.join(metric_columns)} FROM legacy_{table_name}''')
+            conn.execute(f'''
+                INSERT OR IGNORE INTO dim_issuer (구분)
+                SELECT DISTINCT 구분 FROM legacy_{table_name}''')
+            conn.execute(f'''
+                INSERT OR REPLACE INTO fact_value (period, metric_id, issuer_id, value)
+                SELECT CAST(t.기준년월 AS INTEGER), m.metric_id, i.issuer_id, t.value
+                  FROM legacy_{table_name} t
+                  JOIN dim_metric m USING ({', '.join(metric_columns)})
+                  JOIN dim_issuer i USING (구분)''')
+            conn.execute(f'DROP TABLE legacy_{table_name}')
+        conn.execute(f'''
+            CREATE TABLE IF NOT EXISTS {manifest_table} (
+                file_name    TEXT PRIMARY KEY,
+                file_size    INTEGER NOT NULL,
+                content_hash TEXT NOT NULL,
+                기준년월      TEXT NOT NULL,
+                row_count    INTEGER NOT NULL,
+                loaded_at    TEXT NOT NULL DEFAULT (datetime('now')),
+                parquet_hash TEXT
+            )''')
+        columns = [row[1] for row in conn.execute(f'PRAGMA table_info({manifest_table})')]
+        if 'parquet_hash' not in columns:
+            # content_hash of the file the month's Parquet partitions were written from
+            conn.execute(f'ALTER TABLE {manifest_table} ADD COLUMN parquet_hash TEXT')
+        conn.execute(f'''
+            CREATE TABLE IF NOT EXISTS {version_table} (
+                id         INTEGER PRIMARY KEY CHECK (id = 1),
+                version    INTEGER NOT NULL,
+                updated_at TEXT NOT NULL DEFAULT (datetime('now'))
+            )''')
+        conn.execute(f'INSERT OR IGNORE INTO {version_table} (id, version) VALUES (1, 0)')
+        if create_summary_table(conn):
+            # New or reshaped summary table: materialize all months already loaded
+            refresh_summary(conn, SUMMARY_METRICS.values())
+            refresh_derived(conn)
+            bump_version(conn)
+
+    if legacy:
+        # Reclaim the space of the dropped wide table
+        conn.execute('VACUUM')
 
-    df_list.append(df)
 
-if df_list:
-    master_df = pd.concat(df_list, ignore_index=True)
+def lookup_ids(conn, df):
+    """Return metric_id and issuer_id lists for df, registering unseen labels and issuers."""
+    conn.executemany(f'''
+        INSERT OR IGNORE INTO dim_metric ({', '.join(metric_columns)}) VALUES (?, ?, ?, ?, ?)''',
+        df[metric_columns].drop_duplicates().itertuples(index=False, name=None))
+    conn.executemany('INSERT OR IGNORE INTO dim_issuer (구분) VALUES (?)',
+                     [(issuer,) for issuer in df['구분'].unique()])
+
+    dim_metric = pd.DataFrame(
+        conn.execute(f'SELECT metric_id, {", ".join(metric_columns)} FROM dim_metric').fetchall(),
+        columns=['metric_id', *metric_columns])
+    issuer_ids = dict(conn.execute('SELECT 구분, issuer_id FROM dim_issuer').fetchall())
+    # Vectorized label -> id lookup
+    positions = pd.MultiIndex.from_frame(dim_metric[metric_columns]).get_indexer(
+        pd.MultiIndex.from_frame(df[metric_columns]))
+    metric_id = dim_metric['metric_id'].to_numpy()[positions].tolist()
+    issuer_id = df['구분'].map(issuer_ids).tolist()
+    return metric_id, issuer_id
+
+
+def insert_rows(conn, df):
+    """Append a month frame (or chunk) to fact_value on the caller's transaction."""
+    # DataFrame.to_sql commits on its own, which would break the single ingest transaction
+    metric_id, issuer_id = lookup_ids(conn, df)
+    period = df['기준년월'].astype(int).tolist()
+    # NaN -> NULL
+    value = [None if v != v else v for v in df['value'].tolist()]
+    conn.executemany('INSERT OR REPLACE INTO fact_value VALUES (?, ?, ?, ?)',
+                     zip(period, metric_id, issuer_id, value))
+
+
+@profiled()
+def check_load(conn, periods):
+    """Check the loaded months on the ingest transaction; exits (rolling it back) if a blocking check fails."""
+    try:
+        report = check_loaded(conn, periods)
+    except ConsistencyError as e:
+        write_report(e.report)
+        raise SystemExit(f"Load blocked by the consistency checks (see {REPORT_PATH}):\n  "
+                         + '\n  '.join(summary_lines(e.report)))
+    write_report(report)
+    print(f"Checked {report['periods']} month(s) in {report['elapsed_s']:.2f}s.")
+    for line in summary_lines(report):
+        print('  ' + line)
+
+
+@profiled()
+def pending_files(conn, csv_files, full=False, changed=None):
+    """
+    Return (file, size, hash) for every CSV that is new or changed since the last ingest.
+
+    changed: CSVs 0_fetch_data.py reported as converted since the last load. When
+    given, the other files are only hashed if they are new or their size changed.
+    """
+    loaded = {} if full else {
+        name: (size, digest)
+        for name, size, digest in conn.execute(
+            f'SELECT file_name, file_size, content_hash FROM {manifest_table}')
+    }
+    pending = []
+    for file in csv_files:
+        file_path = os.path.join(csv_folder, file)
+        size = os.path.getsize(file_path)
+        if changed is not None and file not in changed and loaded.get(file, (None,))[0] == size:
+            continue
+        digest = file_sha256(file_path)
+        if loaded.get(file) != (size, digest):
+            pending.append((file, size, digest))
+    return pending
+
+
+@profiled()
+def ingest(conn, pending, full=False, checks=True):
+    """Replace the months in `pending` inside one transaction (checked unless checks=False). Returns rows written."""
+    rows_written = 0
+    loaded_periods = []
+    with conn:
+        conn.execute('BEGIN IMMEDIATE')
+        if full:
+            conn.execute('DELETE FROM fact_value')
+            conn.execute(f'DELETE FROM {manifest_table}')
+            # Cheaper to build the secondary index once over the loaded table
+            conn.execute('DROP INDEX IF EXISTS idx_fact_value_period')
+        for file, size, digest in pending:
+            periods, file_rows = [], 0
+            for chunk in read_csv_chunks(os.path.join(csv_folder, file)):
+                # Drop the previous version of the month(s) before inserting the new one
+                new_periods = [p for p in chunk['기준년월'].unique().tolist() if p not in periods]
+                if not full:
+                    conn.executemany('DELETE FROM fact_value WHERE period = ?',
+                                     [(int(p),) for p in new_periods])
+                periods.extend(new_periods)
+                with span('insert', rows=len(chunk)):
+                    insert_rows(conn, chunk)
+                file_rows += len(chunk)
+            conn.execute(f'''
+                INSERT INTO {manifest_table} (file_name, file_size, content_hash, 기준년월, row_count)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT(file_name) DO UPDATE SET
+                    file_size = excluded.file_size,
+                    content_hash = excluded.content_hash,
+                    기준년월 = excluded.기준년월,
+                    row_count = excluded.row_count,
+                    loaded_at = datetime('now')
+                ''', (file, size, digest, ','.join(periods), file_rows))
+            rows_written += file_rows
+            loaded_periods.extend(periods)
+        if full:
+            with span('create_index'):
+                conn.execute('CREATE INDEX IF NOT EXISTS idx_fact_value_period ON fact_value (period)')
+        if checks:
+            check_load(conn, None if full else loaded_periods)
+        with span('refresh_summary'):
+            refresh_summary(conn, SUMMARY_METRICS.values(), None if full else loaded_periods)
+        # Growth rates span months, so derived metrics are recomputed over the whole history
+        with span('refresh_derived'):
+            refresh_derived(conn)
+        bump_version(conn)
+        with span('commit'):
+            conn.commit()
+
+    if full:
+        # Rebuilt by mirror_parquet() from the new manifest
+        shutil.rmtree(parquet_dir, ignore_errors=True)
+    return rows_written
+
+
+def stale_parquet(conn):
+    """(file, hash) of the loaded files whose Parquet partitions are missing or were written from another version."""
+    rows = conn.execute(f'SELECT file_name, content_hash, 기준년월, parquet_hash FROM {manifest_table}').fetchall()
+    return [(file, digest) for file, digest, periods, mirrored in rows
+            if mirrored != digest or not all(partition_exists(p) for p in periods.split(','))]
+
+
+@profiled()
+def mirror_parquet(conn):
+    """Write the Parquet partitions of every loaded file not mirrored yet, one file at a time. Returns the files."""
+    stale = stale_parquet(conn)
+    for file, digest in stale:
+        with span('write_parquet') as s:
+            df = read_month_csv(os.path.join(csv_folder, file))
+            write_months(df)
+            s.rows = len(df)
+        # Recorded per file, so an interrupted run resumes where it stopped
+        with conn:
+            conn.execute(f'UPDATE {manifest_table} SET parquet_hash = ? WHERE file_name = ?', (digest, file))
+    return [file for file, _ in stale]
+
+
+def previous_version(path):
+    """Data version of the database at path (0 if none), so a rebuilt file keeps counting up."""
+    if not os.path.exists(path):
+        return 0
+    conn = sqlite3.connect(path)
+    try:
+        return read_data_version(conn)
+    finally:
+        conn.close()
+
+
+args = parse_args()
+
+# Timing report in profile/load.json when CREFIA_PROFILE=1
+start_report('load')
+
+# Get all CSV files in the folder
+csv_files = sorted(f for f in os.listdir(csv_folder) if f.endswith('.csv'))
+# Months reconverted by 0_fetch_data.py since the last load (None: check every file)
+changed = read_changed()
+
+if args.full:
+    # Build a complete new file next to master.db, then swap it in atomically:
+    # readers keep the old file until the new one is ready
+    build_filename = db_filename + '.building'
+    if os.path.exists(build_filename):
+        os.remove(build_filename)
+    conn = connect_for_build(build_filename)
+    try:
+        ensure_schema(conn)
+        with conn:
+            conn.execute(f'UPDATE {version_table} SET version = ?', (previous_version(db_filename),))
+        pending = pending_files(conn, csv_files, full=True)
+        rows_written = ingest(conn, pending, full=True, checks=args.checks)
+    finally:
+        conn.close()
+    with span('swap_in'):
+        swap_in(build_filename, db_filename)
+    print(f"Rebuilt {db_filename} from {len(pending)} file(s), {rows_written} rows.")
 else:
-    master_df = pd.DataFrame()  # Empty DataFrame if no CSVs found
+    # Save the new or changed months to the SQLite database, in place:
+    # with WAL journaling readers keep seeing the last committed state meanwhile
+    conn = connect_for_ingest(db_filename)
+    try:
+        ensure_schema(conn)
+        pending = pending_files(conn, csv_files, changed=changed)
+        if pending:
+            rows_written = ingest(conn, pending, checks=args.checks)
+            print(f"Loaded {len(pending)} file(s), {rows_written} rows into fact_value: "
+                  + ', '.join(file for file, _, _ in pending))
+        else:
+            print(f"{table_name} is up to date, nothing to load.")
+    finally:
+        conn.close()
+
+# Bring parquet/ up to date with the committed months (all of them after a rebuild or on a fresh clone)
+conn = connect_for_ingest(db_filename)
+try:
+    mirrored = mirror_parquet(conn)
+    if mirrored:
+        print(f"Wrote {len(mirrored)} file(s) to {parquet_dir}/.")
+
+    # Everything 0_fetch_data.py converted is loaded now
+    clear_changed()
 
-# Save the DataFrame to a SQLite database
-with sqlite3.connect(db_filename) as conn:
-    master_df.to_sql(table_name, conn, if_exists='replace', index=False)
+    # Pre-render the dashboard's charts and tables for the new data version (see crefia_export.py).
+    # Before the checkpoint: this writer must be the last connection to close, or
+    # master.db-wal and master.db-shm are left next to master.db
+    manifest = export_static(db_filename)
+    print(f"Export in {os.path.join(export_dir, manifest['dir'])} is at data version {manifest['data_version']}.")
+    with span('checkpoint'):
+        checkpoint(conn)
+finally:
+    conn.close()
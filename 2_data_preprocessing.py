@@ -1,18 +1,35 @@
 # %% 
 import pandas as pd
-import sqlite3
 
-db_filename = 'master.db'
-table_name = 'master_table'
+from crefia_db import read_connection
+from crefia_parquet import load_data
+from crefia_stream import OUT_OF_CORE, iter_long
 
-# Connect to the SQLite database and load the data into a DataFrame
-with sqlite3.connect(db_filename) as conn:
-    df = pd.read_sql_query(f"SELECT * FROM {table_name}", conn)
+# Rows of the master data shown in out-of-core mode
+PREVIEW_ROWS = 1000
 
-# Now df contains the data from master.db and is ready for preprocessing
+if OUT_OF_CORE:
+    # Don't materialize the whole history: df is the first PREVIEW_ROWS rows of the
+    # long table streamed from master.db (same columns, in fact_value key order);
+    # the row count is taken in SQL
+    with read_connection() as conn:
+        chunks = iter_long(conn)
+        df = next(chunks, pd.DataFrame()).head(PREVIEW_ROWS)
+        chunks.close()
+        total_rows = conn.execute('SELECT COUNT(*) FROM fact_value').fetchone()[0]
+    print(f"Out-of-core mode: df shows the first {len(df)} of {total_rows} rows")
+else:
+    # Load the Parquet dataset written by 1_to_sqlite3.py into a DataFrame
+    df = load_data()
+
+# Now df contains the master data and is ready for preprocessing
 df
 # %% 회원수
-df_mbrs = df[df['대분류'] == '회원수']
+if OUT_OF_CORE:
+    # The filter runs in SQL; only the 회원수 rows are streamed
+    with read_connection() as conn:
+        df_mbrs = pd.concat(iter_long(conn, 대분류='회원수'), ignore_index=True)
+else:
+    # Only the 회원수 row groups are read
+    df_mbrs = load_data(filters=[('대분류', '==', '회원수')])
 df_mbrs
-
-# %% 
\ No newline at end of file
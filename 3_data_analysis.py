@@ -1,31 +1,39 @@
 # %%
 import pandas as pd
-import sqlite3
 
-
-db_filename = 'master.db'
-table_name = 'master_table'
-
-# Connect to the SQLite database and load the data into a DataFrame
-with sqlite3.connect(db_filename) as conn:
-    df = pd.read_sql_query(f'''
-    SELECT * 
-      FROM {table_name}
-     WHERE 1=1
-       AND 구분 IN ('롯데카드', '삼성카드', '신한카드', '우리카드', 
-                   '하나카드', '현대카드', 'KB국민카드', 'NH농협카드')
-    ''', conn)
+from crefia_cube import Cube
+from crefia_db import read_connection
+from crefia_derived import DERIVED_METRICS
+from crefia_metrics import SUMMARY_ISSUERS, read_summary
+from crefia_parquet import load_data
+from crefia_stream import OUT_OF_CORE, load_cube
+
+ANALYSIS_ISSUERS = ['롯데카드', '삼성카드', '신한카드', '우리카드',
+                    '하나카드', '현대카드', 'KB국민카드', 'NH농협카드']
+
+if OUT_OF_CORE:
+    # Stream fact_value from master.db chunk by chunk straight into the cube,
+    # within CREFIA_MEMORY_BUDGET_MB (the long frame is never built)
+    with read_connection() as conn:
+        cube = load_cube(conn, issuers=ANALYSIS_ISSUERS)
+else:
+    # Load the data from the Parquet dataset written by 1_to_sqlite3.py,
+    # reading only the issuers of interest (filters are pushed down to the files)
+    df = load_data(filters=[('구분', 'in', ANALYSIS_ISSUERS)])
+
+    # Dense (period x label row x issuer) cube: slicing by dimensions doesn't copy the frame
+    cube = Cube.from_long(df, labels=pd.read_csv('crefia_label.csv'))
 
 # %% 1. Data Segmentation
-df_sales = df[df['대분류'].isin(['국내이용금액', '해외이용금액'])]
-df_mbrs = df[df['대분류'] == '회원수']
-df_fin = df[df['대분류'] == '금융자산']
+df_sales = cube.select(대분류=['국내이용금액', '해외이용금액']).to_long()
+df_mbrs = cube.select(대분류='회원수').to_long()
+df_fin = cube.select(대분류='금융자산').to_long()
 
 # %% 2. Sales
 print(df_sales.shape)
 
-df_sales_psn = df_sales[df_sales['개인법인구분'] == '개인']
-df_sales_co = df_sales[df_sales['개인법인구분'] == '법인']
+df_sales_psn = cube.select(대분류=['국내이용금액', '해외이용금액'], 개인법인구분='개인').to_long()
+df_sales_co = cube.select(대분류=['국내이용금액', '해외이용금액'], 개인법인구분='법인').to_long()
 
 # 3-1. 개인회원
 print(df_sales_psn.shape)
@@ -36,14 +44,15 @@ print(df_sales_co.shape)
 
 # %% 3. Members
 print(df_mbrs.shape)
-df_mbrs_psn = df_mbrs[df_mbrs['개인법인구분'] == '개인']
-df_mbrs_co = df_mbrs[df_mbrs['개인법인구분'] == '법인']
+df_mbrs_psn = cube.select(대분류='회원수', 개인법인구분='개인').to_long()
+df_mbrs_co = cube.select(대분류='회원수', 개인법인구분='법인').to_long()
 
 # 3-1. 개인회원
 print(df_mbrs_psn.shape)
 print(df_mbrs_psn.groupby('신용체크구분').count())
-df_mbrs_psn_crd = df_mbrs_psn[df_mbrs_psn['신용체크구분'] == '신용카드']
-df_mbrs_psn_cnf = df_mbrs_psn[df_mbrs_psn['신용체크구분'] == '직불/체크카드']
+mbrs_psn_crd = cube.select(대분류='회원수', 개인법인구분='개인', 신용체크구분='신용카드')
+df_mbrs_psn_crd = mbrs_psn_crd.to_long()
+df_mbrs_psn_cnf = cube.select(대분류='회원수', 개인법인구분='개인', 신용체크구분='직불/체크카드').to_long()
 
 print(df_mbrs_psn_crd[['중분류', '소분류']].value_counts())
 
@@ -66,7 +75,7 @@ card_colors = {
 
 # 전체회원수
 plt.figure(figsize=(10, 5))
-df_plot = df_mbrs_psn_crd[df_mbrs_psn_crd['중분류'] == '전체회원수']
+df_plot = mbrs_psn_crd.select(중분류='전체회원수').to_long()
 # Sort by 기준년월 for proper line plotting
 df_plot = df_plot.sort_values('기준년월')
 
@@ -88,7 +97,7 @@ plt.show()
 
 # 이용회원수
 plt.figure(figsize=(10, 5))
-df_plot = df_mbrs_psn_crd[df_mbrs_psn_crd['중분류'] == '전체이용회원수']
+df_plot = mbrs_psn_crd.select(중분류='전체이용회원수').to_long()
 df_plot = df_plot.sort_values('기준년월')
 
 # Get unique 카드사(구분) in plotting order
@@ -109,7 +118,7 @@ plt.show()
 
 # 신규회원수
 plt.figure(figsize=(10, 5))
-df_plot = df_mbrs_psn_crd[df_mbrs_psn_crd['중분류'] == '신규회원수(월중)']
+df_plot = mbrs_psn_crd.select(중분류='신규회원수(월중)').to_long()
 df_plot = df_plot.sort_values('기준년월')
 
 card_order = df_plot['구분'].unique().tolist()
@@ -128,7 +137,7 @@ plt.show()
 
 # 해지회원수
 plt.figure(figsize=(10, 5))
-df_plot = df_mbrs_psn_crd[df_mbrs_psn_crd['중분류'] == '해지회원수(월중)']
+df_plot = mbrs_psn_crd.select(중분류='해지회원수(월중)').to_long()
 df_plot = df_plot.sort_values('기준년월')
 
 card_order = df_plot['구분'].unique().tolist()
@@ -153,4 +162,16 @@ print(df_mbrs_co.groupby('신용체크구분').count())
 
 
 # %% 4. Finance
-print(df_fin.shape)
\ No newline at end of file
+print(df_fin.shape)
+
+
+# %% 5. Derived metrics
+# MoM/YoY growth, net adds, churn, activation and market shares per 대분류 are
+# computed once per ingest by 1_to_sqlite3.py (crefia_derived.py) and stored in master.db
+with read_connection() as conn:
+    derived = read_summary(conn, DERIVED_METRICS.values(), SUMMARY_ISSUERS)
+
+print(derived['net_adds'].tail(12))
+print(derived['churn_rate'].tail(12))
+print(derived['activation_rate'].tail(12))
+print(derived['share_국내이용금액'].tail(12))
@@ -4,398 +4,233 @@ visualize_data.py
 Loads the processed/master data and provides the Streamlit dashboard for interactive visualization.
 """
 # %% 
-import sqlite3
-import pandas as pd
-import matplotlib.pyplot as plt
+import os
+from concurrent.futures import as_completed
 
-import altair as alt
+import pandas as pd
 import streamlit as st
 
+from crefia_charts import chart_caption, line_chart
+from crefia_db import read_connection
+from crefia_export import export_dir, load_manifest, load_spec, manifest_name
+from crefia_metrics import SUMMARY_METRICS, read_data_version
+from crefia_prefetch import prefetch_shared
+from crefia_profile import ENABLED as PROFILE_ENABLED, mark, records, span, summary
+from crefia_period import to_ordinal, to_period
+from crefia_sections import PERIODS_JOB, page_jobs
+
 # DB Settings
 db_filename = 'master.db'
 table_name = 'master_table'
 
-# Display Settings
-plt.rc('font', family='NanumGothic')
-plt.rcParams['axes.unicode_minus'] = False
-
-# Design Settings
-CI_color = {
-    '신한카드': '#0046FF',  # Shinhan Blue
-    '현대카드': '#222222',  # 현대 블랙
-    '우리카드': '#20C4F4',  # 우리 스카이 블루
-    '삼성카드': '#1428A0',  # 삼성 블루
-    '롯데카드': '#ED1C24',  # 롯데 레드
-    '하나카드': '#1DB2A5',  # 하나 민트
-    'KB국민카드': '#FFBC00', # KB Yellow Positive
-}
-# Build color scale for Altair using CI_color
-CI_color_scale = alt.Scale(domain=list(CI_color.keys()), range=list(CI_color.values()))
+# %% Data
+def db_mtime():
+    """Modification stamp of master.db (and its WAL file), read without opening the database."""
+    paths = [db_filename, db_filename + '-wal']
+    return tuple(os.stat(path).st_mtime_ns for path in paths if os.path.exists(path))
 
-# %% 0. Title
-st.title('여신금융협회 자료 분석 (카드사별)')
-st.divider()
 
+@st.cache_data(show_spinner=False)
+def get_data_version(mtime):
+    """Data version stamp written by 1_to_sqlite3.py. Re-read only when master.db changes on disk."""
+    with span('get_data_version'), read_connection(db_filename) as conn:
+        return read_data_version(conn)
 
 
+@st.cache_resource(show_spinner=False, max_entries=1)
+def prefetch_sections(data_version):
+    """
+    Start the queries of the page (the period axis and every section) at once on the query thread pool.
 
-# %% 1. Sales
+    The futures are shared by every rerun and session until the next ingest,
+    so once resolved they are served from memory. When the app was started by
+    crefia_serve.py, they were already started by its warm-up.
+    """
+    return prefetch_shared(db_filename, data_version, page_jobs())
 
 
-# %% 2. Members
-# ==============================================================
-# 2-1. Total Members
-# ==============================================================
-st.subheader('회원수 (개인)')
-
-with sqlite3.connect(db_filename) as conn:
-    # 전체회원수 (신용+체크)
-    df_total_members = pd.read_sql_query(f'''
-        SELECT 기준년월, 구분, SUM(value) as value
-          FROM master_table
-         WHERE 1=1
-           AND 개인법인구분 = '개인'
-           AND 대분류 = '회원수'
-           AND 중분류 = '전체회원수'
-           AND 소분류 = '합계'
-           AND 구분 IN ('롯데카드', '삼성카드', '신한카드', '우리카드', 
-                        '하나카드', '현대카드', 'KB국민카드')
-         GROUP BY 기준년월, 구분
-        ''', conn)
-
-    # 전체신용회원수
-    df_crd_mbrs = pd.read_sql_query(f'''
-        SELECT 기준년월, 구분, value
-          FROM master_table
-         WHERE 1=1
-           AND 개인법인구분 = '개인'
-           AND 신용체크구분 = '신용카드'
-           AND 대분류 = '회원수'
-           AND 중분류 = '전체회원수'
-           AND 소분류 = '본인기준회원수'
-           AND 구분 IN ('롯데카드', '삼성카드', '신한카드', '우리카드', 
-                        '하나카드', '현대카드', 'KB국민카드')
-        ''', conn)
-
-    # 전체체크회원수
-    df_cnf_mbrs = pd.read_sql_query(f'''
-        SELECT 기준년월, 구분, value
-          FROM master_table
-         WHERE 1=1
-           AND 개인법인구분 = '개인'
-           AND 신용체크구분 = '직불/체크카드'
-           AND 대분류 = '회원수'
-           AND 중분류 = '사용가능회원수'
-           AND 소분류 = '사용가능회원수'
-           AND 구분 IN ('롯데카드', '삼성카드', '신한카드', '우리카드', 
-                        '하나카드', '현대카드', 'KB국민카드')
-        ''', conn)
-
-
-# 기간 슬라이더 공통
+def export_mtime():
+    """Modification stamp of the export manifest (None if there is none)."""
+    try:
+        return os.stat(os.path.join(export_dir, manifest_name)).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+@st.cache_data(show_spinner=False)
+def get_export_manifest(data_version, mtime):
+    """Manifest of the pre-rendered charts (crefia_export.py), if they were rendered from this data version."""
+    manifest = load_manifest()
+    if manifest is None or manifest['data_version'] != data_version:
+        return None
+    return manifest
+
+
+@st.cache_data(show_spinner=False)
+def get_exported_spec(data_version, path):
+    with span('load_exported_spec'):
+        return load_spec(get_export_manifest(data_version, export_mtime()), path)
+
+
+def exported_chart(name, start, end):
+    """(Vega-Lite spec, resolution) pre-rendered for this metric and period range, else None."""
+    data_version = get_data_version(db_mtime())
+    manifest = get_export_manifest(data_version, export_mtime())
+    if manifest is None:
+        return None
+    for entry in manifest['charts'].get(name, {}).values():
+        if (entry['start'], entry['end']) == (start, end):
+            try:
+                return get_exported_spec(data_version, entry['path']), entry['resolution']
+            except OSError:
+                # Replaced by a newer export meanwhile
+                return None
+    return None
+
+
+def lazy_tabs(labels, key):
+    """st.tabs that only runs the selected tab's code, where the installed Streamlit supports it."""
+    try:
+        return st.tabs(labels, key=key, on_change='rerun')
+    except TypeError:
+        # Older Streamlit: every tab is computed and sent to the browser
+        return st.tabs(labels)
+
+
+def tab_is_open(tab):
+    """False only for a tab known to be hidden."""
+    return getattr(tab, 'open', None) is not False
+
+
+# 기간 슬라이더 공통: one range for every section
 def get_period_slider(periods, label):
+    """Period range control over every month with data. Returns the (start, end) month ordinals."""
     default_period = [periods[0], periods[-1]] if len(periods) > 1 else periods
 
-    return st.select_slider(
+    selected_period = st.select_slider(
         label,
         options=periods,
         value=default_period,
-        label_visibility='collapsed'
+        key='period_range',
     )
+    if isinstance(selected_period, (list, tuple)):
+        start_period, end_period = selected_period
+    else:
+        start_period = end_period = selected_period
+    return to_ordinal(start_period), to_ordinal(end_period)
+
+
+def draw_line_chart(frame, spec, start, end):
+    """Issuer line chart of a metric's months start..end (ordinals); pre-rendered when the export has the range."""
+    bounds = frame.bounds(start, end)
+    exported = exported_chart(spec.name, *map(to_period, bounds)) if bounds else None
+    if exported is not None:
+        vega_spec, resolution = exported
+    else:
+        chart, resolution = line_chart(frame.slice(start, end), spec.title, spec.rollup)
+
+    st.caption(chart_caption(resolution, spec.rollup))
+    with span('altair_chart'):
+        if exported is not None:
+            st.vega_lite_chart(vega_spec, use_container_width=True)
+        else:
+            st.altair_chart(chart, use_container_width=True)
+
+
+def metric_section(title, tabs, key):
+    """
+    Renderer of a section of metrics: {tab label: metric name}.
+
+    Every metric comes from the section's one cached query, already indexed by
+    month (crefia_period.py), and only the open tab's chart and table are built.
+    """
+    def render(metrics, pivots, start, end):
+        st.subheader(title)
+
+        containers = lazy_tabs(list(tabs), key=key) if len(tabs) > 1 else [st.container()]
+        for container, name in zip(containers, tabs.values()):
+            with container:
+                if tab_is_open(container):
+                    draw_line_chart(metrics[name], SUMMARY_METRICS[name], start, end)
+                    # Newest month first
+                    st.dataframe(pivots[name].slice(start, end).iloc[::-1], height=200)
+
+        st.divider()
+    return render
 
-# Slider Settings
-periods = sorted(df_total_members['기준년월'].unique())
-selected_period = get_period_slider(periods, '기간 선택 (기준년월)')
-start_period, end_period = selected_period
-    
-# Create Tabs: 회원수 (개인)
-tab1, tab2 = st.tabs(["신용", "체크"])
-
-# 신용회원수
-with tab1:
-    # Limit Data Range
-    df_chart = df_crd_mbrs[
-        (df_crd_mbrs['기준년월'] >= start_period) & (df_crd_mbrs['기준년월'] <= end_period)
-    ]
-
-    # Add Highlight Points
-    highlight = alt.selection_point(fields=['구분'], bind='legend', nearest=True)
-    
-    # Draw a Chart
-    chart = alt.Chart(df_chart
-        ).mark_line(point={'size':75}
-        ).encode(
-            x=alt.X('기준년월:N', title='기준년월', sort=sorted(df_crd_mbrs['기준년월'].unique()),
-                    axis=alt.Axis(labelAngle=270, labelOverlap=True)),
-            y=alt.Y('value:Q', title='전체신용회원수', scale=alt.Scale()),
-            color=alt.Color('구분:N', scale=CI_color_scale, title=None, legend=alt.Legend(orient='bottom')),
-            opacity=alt.condition(highlight, alt.value(1), alt.value(0.1))
-        ).add_params(
-            highlight
-        ).interactive(
-        ).properties(height=400)
-    st.caption("ℹ️ Shift+Click legend to multi-select lines.")
-    st.altair_chart(chart, use_container_width=True)
-    st.dataframe(
-        df_chart.pivot(index='기준년월', columns='구분', values='value')\
-                .sort_values(by='기준년월', ascending=False),
-        height=200
-    )
 
-# 체크회원수
-with tab2:
-    # Limit Data Range
-    df_chart = df_cnf_mbrs[
-        (df_cnf_mbrs['기준년월'] >= start_period) & (df_cnf_mbrs['기준년월'] <= end_period)
-    ]
-
-    # Add Highlight Points
-    highlight = alt.selection_point(fields=['구분'], bind='legend', nearest=True)
-    
-    # Draw a Chart
-    chart = alt.Chart(df_chart
-        ).mark_line(point={'size':75}
-        ).encode(
-            x=alt.X('기준년월:N', title='기준년월', sort=sorted(df_cnf_mbrs['기준년월'].unique()),
-                    axis=alt.Axis(labelAngle=270, labelOverlap=True)),
-            y=alt.Y('value:Q', title='전체체크회원수', scale=alt.Scale()),
-            color=alt.Color('구분:N', scale=CI_color_scale, title=None, legend=alt.Legend(orient='bottom')),
-            opacity=alt.condition(highlight, alt.value(1), alt.value(0.1))
-        ).add_params(
-            highlight
-        ).interactive(
-        ).properties(height=400)
-    st.caption("ℹ️ Shift+Click legend to multi-select lines.")
-    st.altair_chart(chart, use_container_width=True)
-    st.dataframe(
-        df_chart.pivot(index='기준년월', columns='구분', values='value').sort_values(by='기준년월', ascending=False),
-        height=200
-    )
+# %% 1. Sales
+render_sales = metric_section('이용금액 (신용+체크, 개인+법인)',
+                              {'국내': 'domestic_sales', '해외': 'overseas_sales'}, key='sales_tabs')
 
-st.divider()
 
+# %% 2. Members
+# 2-1. Total Members: 신용 / 체크 tabs
+render_members = metric_section('회원수 (개인)', {'신용': 'crd_mbrs', '체크': 'cnf_mbrs'}, key='members_tabs')
 
-# ==============================================================
 # 2-2. Active Users (활동회원수)
-# ==============================================================
-with sqlite3.connect(db_filename) as conn:
-    df_active_users = pd.read_sql_query(f'''
-        SELECT 기준년월, 구분, value 
-          FROM master_table
-         WHERE 1=1
-           AND 개인법인구분 = '개인'
-           AND 신용체크구분 = '신용카드'
-           AND 대분류 = '회원수'
-           AND 중분류 = '전체이용회원수'
-           AND 소분류 = '합계'
-           AND 구분 IN ('롯데카드', '삼성카드', '신한카드', '우리카드', 
-                       '하나카드', '현대카드', 'KB국민카드')
-        ''', conn)
-
-st.subheader('이용회원수 (신용카드, 개인)')
-
-# Prepare the data for Altair
-df_active_chart = df_active_users.copy()
-df_active_chart['기준년월'] = df_active_chart['기준년월'].astype(str)
-
-# Add period selection component
-active_periods = sorted(df_active_chart['기준년월'].unique())
-default_active_period = [active_periods[0], active_periods[-1]] if len(active_periods) > 1 else active_periods
-start_active_period, end_active_period = st.select_slider(label='기간',
-                                                          options=active_periods,
-                                                          value=default_active_period,
-                                                          label_visibility="collapsed"
-                                                         )
-df_active_chart_period = df_active_chart[
-    (df_active_chart['기준년월'] >= start_active_period) & (df_active_chart['기준년월'] <= end_active_period)
-]
-
-# Plot Altair chart
-highlight = alt.selection_point(fields=['구분'], bind='legend')
-
-active_chart = alt.Chart(df_active_chart_period
-    ).mark_line(
-        point={"size":75}
-    ).encode(
-        x=alt.X('기준년월:N', title='기준년월', sort=active_periods),
-        y=alt.Y('value:Q', title='이용회원수'),
-        color=alt.Color(
-            '구분:N',
-            scale=CI_color_scale,
-            title=None,
-            legend=alt.Legend(orient='bottom')
-        ),
-        opacity=alt.condition(highlight, alt.value(1), alt.value(0.1))
-    ).add_params(
-        highlight
-    ).interactive(
-        # Pan / Zoom
-    ).properties(   
-        # Width / Height
-        height=400
-    )
-
-st.caption("ℹ️ Shift+Click legend to multi-select lines.")
-st.altair_chart(active_chart, use_container_width=True)
+render_active_users = metric_section('이용회원수 (신용카드, 개인)', {'이용회원수': 'active_users'},
+                                     key='active_users_tabs')
 
-st.dataframe(
-    df_active_users.pivot(index='기준년월', columns='구분', values='value')\
-                   .sort_values(by='기준년월', ascending=False),
-    height=200
-)
-st.divider()
-
-# ==============================================================
 # 2-3. 신규회원수
-# ==============================================================
-with sqlite3.connect(db_filename) as conn:
-    df_new_users = pd.read_sql_query(f'''
-        SELECT 기준년월, 구분, value 
-          FROM master_table
-         WHERE 1=1
-           AND 개인법인구분 = '개인'
-           AND 신용체크구분 = '신용카드'
-           AND 대분류 = '회원수'
-           AND 중분류 = '신규회원수(월중)'
-           AND 소분류 = '본인기준회원수'
-           AND 구분 IN ('롯데카드', '삼성카드', '신한카드', '우리카드', 
-                       '하나카드', '현대카드', 'KB국민카드')
-        ''', conn)
-
-st.subheader('신규회원수 (신용카드 - 개인, 월중)')
-
-# Prepare the data for Altair
-df_new_chart = df_new_users.copy()
-
-# Add period selection component
-new_periods = sorted(df_new_chart['기준년월'].unique())
-default_new_period = [new_periods[0], new_periods[-1]] if len(new_periods) > 1 else new_periods
-selected_new_period = st.select_slider(
-    '기간 선택 (기준년월, 신규회원수)',
-    options=new_periods,
-    value=default_new_period,
-    label_visibility="collapsed"
-)
-
-# Filter data by selected period
-if isinstance(selected_new_period, list) or isinstance(selected_new_period, tuple):
-    start_new_period, end_new_period = selected_new_period
-else:
-    start_new_period = end_new_period = selected_new_period
-
-df_new_chart_period = df_new_chart[
-    (df_new_chart['기준년월'] >= start_new_period) & (df_new_chart['기준년월'] <= end_new_period)
-]
-
-# Plot Altair chart
-highlight = alt.selection_point(fields=['구분'], bind='legend')
-
-new_chart = alt.Chart(df_new_chart_period
-    ).mark_line(
-        point={'size':75}
-    ).encode(
-        x=alt.X('기준년월:N', title='기준년월', sort=new_periods),
-        y=alt.Y('value:Q', title='신규회원수'),
-        color=alt.Color(
-            '구분:N',
-            scale=CI_color_scale,
-            title=None,
-            legend=alt.Legend(orient='bottom')
-        ),
-        opacity=alt.condition(highlight, alt.value(1), alt.value(0.1))
-    ).add_params(
-        highlight
-    ).interactive(
-        # Pan / Zoom
-    ).properties(   
-        # Width / Height
-        height=400
-    )
+render_new_users = metric_section('신규회원수 (신용카드 - 개인, 월중)', {'신규회원수': 'new_users'},
+                                  key='new_users_tabs')
 
-st.caption("ℹ️ Shift+Click legend to multi-select lines.")
-st.altair_chart(new_chart, use_container_width=True)
+# 2-4. 해지회원수
+render_cancel_users = metric_section('해지회원수 (신용카드 - 개인, 월중)', {'해지회원수': 'cancel_users'},
+                                     key='cancel_users_tabs')
 
-st.dataframe(
-    df_new_users.pivot(index='기준년월', columns='구분', values='value')\
-                .sort_values(by='기준년월', ascending=False),
-    height=200
-)
-st.divider()
 
-# ==============================================================
-# 2-4. 해지회원수
-# ==============================================================
-with sqlite3.connect(db_filename) as conn:
-    df_cancel_users = pd.read_sql_query(f'''
-        SELECT 기준년월, 구분, value 
-          FROM master_table
-         WHERE 1=1
-           AND 개인법인구분 = '개인'
-           AND 신용체크구분 = '신용카드'
-           AND 대분류 = '회원수'
-           AND 중분류 = '해지회원수(월중)'
-           AND 소분류 = '해지회원수(월중)'
-           AND 구분 IN ('롯데카드', '삼성카드', '신한카드', '우리카드', 
-                       '하나카드', '현대카드', 'KB국민카드')
-        ''', conn)
-
-st.subheader('해지회원수 (신용카드 - 개인, 월중)')
-
-# Prepare the data for Altair
-df_cancel_chart = df_cancel_users.copy()
-
-# Add period selection component
-cancel_periods = sorted(df_cancel_chart['기준년월'].unique())
-default_cancel_period = [cancel_periods[0], cancel_periods[-1]] if len(cancel_periods) > 1 else cancel_periods
-selected_cancel_period = st.select_slider(
-    '기간 선택 (기준년월, 해지회원수)',
-    options=cancel_periods,
-    value=default_cancel_period,
-    label_visibility="collapsed"
-)
-
-# Filter data by selected period
-if isinstance(selected_cancel_period, list) or isinstance(selected_cancel_period, tuple):
-    start_cancel_period, end_cancel_period = selected_cancel_period
-else:
-    start_cancel_period = end_cancel_period = selected_cancel_period
-
-df_cancel_chart_period = df_cancel_chart[
-    (df_cancel_chart['기준년월'] >= start_cancel_period) & (df_cancel_chart['기준년월'] <= end_cancel_period)
-]
-
-# Plot Altair chart
-highlight = alt.selection_point(fields=['구분'], bind='legend')
-
-cancel_chart = alt.Chart(df_cancel_chart_period
-    ).mark_line(
-        point={"size":75}
-    ).encode(
-        x=alt.X('기준년월:N', title='기준년월', sort=cancel_periods),
-        y=alt.Y('value:Q', title='해지회원수'),
-        color=alt.Color(
-            '구분:N', 
-            scale=CI_color_scale, 
-            title=None,
-            legend=alt.Legend(orient='bottom')
-        ),
-        opacity=alt.condition(highlight, alt.value(1), alt.value(0.1))
-    ).add_params(
-        highlight
-    ).interactive(
-        # Pan / Zoom
-    ).properties(   
-        # Width / Height
-        height=400
-    )
-    
-st.caption("ℹ️ Shift+Click legend to multi-select lines.")
-st.altair_chart(cancel_chart, use_container_width=True)
-
-st.dataframe(
-    df_cancel_users.pivot(index='기준년월', columns='구분', values='value')\
-                   .sort_values(by='기준년월', ascending=False),
-    height=200
-)
-st.divider()
 # %% 3. Finance
+render_finance = metric_section('금융자산', {'금융자산': 'finance_assets'}, key='finance_tabs')
+
+
+# Page sections in display order (crefia_sections.SECTION_METRICS): renderer
+SECTIONS = {
+    'sales': render_sales,
+    'members': render_members,
+    'active_users': render_active_users,
+    'new_users': render_new_users,
+    'cancel_users': render_cancel_users,
+    'finance': render_finance,
+}
+
+
+def main():
+    """Render the page. Nothing is loaded at import time."""
+    # %% 0. Title
+    # Start of this rerun's timing spans (CREFIA_PROFILE=1)
+    rerun_mark = mark()
+
+    st.title('여신금융협회 자료 분석 (카드사별)')
+
+    futures = dict(prefetch_sections(get_data_version(db_mtime())))
+    periods_future = futures.pop(PERIODS_JOB)
+    if periods_future.exception() is not None:
+        prefetch_sections.clear()
+    # One range for the whole page: moving it reruns every section once, with the same months
+    start, end = get_period_slider(periods_future.result(), '기간 선택 (기준년월)')
+    st.divider()
+
+    # %% Sections
+    # One placeholder per section, in page order; each is filled as soon as its query resolves
+    containers = {name: st.container() for name in SECTIONS}
+    sections_by_future = {future: name for name, future in futures.items()}
+    for future in as_completed(sections_by_future):
+        name = sections_by_future[future]
+        if future.exception() is not None:
+            # Don't keep a failed query cached for the next rerun
+            prefetch_sections.clear()
+        with containers[name], span(f'render/{name}'):
+            SECTIONS[name](*future.result(), start, end)
+
+    # %% Timings
+    if PROFILE_ENABLED:
+        # Spans recorded since the rerun started (queries only run on a cache miss);
+        # with several sessions at once, their spans may mix in
+        with st.sidebar.expander('⏱ Timings', expanded=False):
+            df_timings = pd.DataFrame(summary(records(rerun_mark)))
+            st.dataframe(df_timings, hide_index=True)
+
+
+main()
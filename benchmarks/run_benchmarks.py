@@ -0,0 +1,302 @@
+"""
+run_benchmarks.py
+End-to-end pipeline benchmark on synthetic data.
+
+Builds a scratch copy of the pipeline in a temporary directory, generates
+synthetic inputs (see synthetic_data.py), then times each stage in its own
+process:
+  fetch      0_fetch_data.py over synthetic .xls files
+  load       1_to_sqlite3.py over the synthetic CSVs (full load)
+  reload     1_to_sqlite3.py again with one new month (incremental path)
+  dashboard  the dashboard query set (batched metric query + summary read),
+             for one viewer and for --viewers concurrent viewers on the connection pool
+  cold_start a fresh process rendering the first dashboard page (streamlit AppTest)
+             after the crefia_serve.py warm-up, checked against --cold-start-budget
+  api        --viewers concurrent clients requesting every metric of crefia_api.py over
+             HTTP keep-alive, revalidating with If-None-Match on every other round
+
+Results are machine readable (JSON): wall time, peak RSS and rows/sec per
+stage, with the git commit, so runs can be compared across commits. With
+--profile the stages run with CREFIA_PROFILE=1 and each result also carries
+the stage's per-span timings (see crefia_profile.py).
+
+Usage:
+    python benchmarks/run_benchmarks.py --years 20 --issuer-factor 1 --output bench.json
+    python benchmarks/run_benchmarks.py --compare old.json new.json
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+
+import synthetic_data
+
+REPO_DIR = synthetic_data.REPO_DIR
+
+# Seconds a fresh process may take to render the first dashboard page
+COLD_START_BUDGET_S = 3.0
+
+# Files copied into the scratch pipeline directory
+PIPELINE_FILES = ['0_fetch_data.py', '1_to_sqlite3.py', '4_visualize_data.py', 'crefia_label.csv', 'crefia_layout.json']
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_stage(name, args, cwd, rows, report=None):
+    """Run one stage in a child process. Returns its result record (with the spans of `report`, if written)."""
+    if report and os.path.exists(report):
+        os.remove(report)
+    start = time.perf_counter()
+    proc = subprocess.Popen(args, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    output = proc.stdout.read()
+    proc.stdout.close()
+    _, status, usage = os.wait4(proc.pid, 0)
+    wall = time.perf_counter() - start
+    if os.waitstatus_to_exitcode(status) != 0:
+        raise RuntimeError(f'stage {name} failed:\n{output.decode(errors="replace")}')
+
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak_rss = usage.ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+    result = {
+        'stage': name,
+        'wall_s': round(wall, 4),
+        'peak_rss_mb': round(peak_rss / 2**20, 1),
+        'rows': rows,
+        'rows_per_s': round(rows / wall, 1) if wall else None,
+    }
+    if report and os.path.exists(report):
+        with open(report, encoding='utf-8') as f:
+            result['spans'] = json.load(f)['spans']
+    return result
+
+
+def dashboard_queries(db_path, repeat, viewers):
+    """Child-process entry point: `viewers` threads each run the dashboard query set `repeat` times."""
+    from concurrent.futures import ThreadPoolExecutor
+    # Import the copy of the modules in the scratch directory (the working directory)
+    sys.path.insert(0, os.getcwd())
+    from crefia_db import read_connection
+    from crefia_metrics import MEMBER_METRICS, fetch_metrics, read_summary
+
+    def viewer(_):
+        rows = 0
+        for _ in range(repeat):
+            with read_connection(db_path) as conn:
+                rows += sum(len(df) for df in fetch_metrics(conn, MEMBER_METRICS.values()).values())
+                rows += sum(df.size for df in read_summary(conn, MEMBER_METRICS.values()).values())
+        return rows
+
+    with ThreadPoolExecutor(max_workers=viewers) as pool:
+        print(sum(pool.map(viewer, range(viewers))))
+
+
+def api_requests(db_path, repeat, viewers):
+    """Child-process entry point: serve crefia_api.py on a free port and load it with `viewers` clients."""
+    import threading
+    import http.client
+    from concurrent.futures import ThreadPoolExecutor
+    sys.path.insert(0, os.getcwd())
+    import crefia_api
+
+    server = crefia_api.make_server('127.0.0.1', 0, db_path)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    port = server.server_address[1]
+    paths = [f'/metrics/{name}' for name in crefia_api.SUMMARY_METRICS]
+    paths += [path + '?start=201501' for path in paths]
+
+    def client(_):
+        conn = http.client.HTTPConnection('127.0.0.1', port)
+        etags, statuses = {}, []
+        for round_ in range(repeat):
+            for path in paths:
+                headers = {'If-None-Match': etags[path]} if round_ % 2 and path in etags else {}
+                conn.request('GET', path, headers=headers)
+                response = conn.getresponse()
+                response.read()
+                etags[path] = response.getheader('ETag')
+                statuses.append(response.status)
+        conn.close()
+        return statuses
+
+    with ThreadPoolExecutor(max_workers=viewers) as pool:
+        statuses = [status for result in pool.map(client, range(viewers)) for status in result]
+    server.shutdown()
+    if set(statuses) - {200, 304}:
+        raise SystemExit(f'unexpected statuses: {sorted(set(statuses))}')
+    print(len(statuses))
+
+
+def cold_start():
+    """Child-process entry point: start the warm-up as crefia_serve.py does, then render the page once."""
+    import logging
+    import threading
+    sys.path.insert(0, os.getcwd())
+    import crefia_serve
+    threading.Thread(target=crefia_serve.warm_up, daemon=True).start()
+
+    from streamlit.testing.v1 import AppTest
+    # AppTest warns that it runs without `streamlit run`
+    logging.disable(logging.WARNING)
+    page = AppTest.from_file(os.path.join(os.getcwd(), crefia_serve.app_script), default_timeout=60).run()
+    if page.exception:
+        raise SystemExit(f'page raised: {[e.message for e in page.exception]}')
+
+
+def setup_workdir(workdir):
+    """Copy the pipeline scripts and helper modules into workdir."""
+    for file in PIPELINE_FILES + [f for f in os.listdir(REPO_DIR) if f.startswith('crefia_') and f.endswith('.py')]:
+        shutil.copy(os.path.join(REPO_DIR, file), workdir)
+
+
+def count_csv_rows(csv_dir):
+    rows = 0
+    for file in os.listdir(csv_dir):
+        with open(os.path.join(csv_dir, file), 'rb') as f:
+            rows += sum(1 for _ in f) - 1
+    return rows
+
+
+def run_benchmarks(years, issuer_factor, xls_months, dashboard_repeat, viewers, keep=False, profile=False,
+                   cold_start_budget=COLD_START_BUDGET_S):
+    workdir = tempfile.mkdtemp(prefix='crefia_bench_')
+    profile_dir = os.path.join(workdir, 'profile')
+    if profile:
+        # Inherited by the stage processes
+        os.environ['CREFIA_PROFILE'] = '1'
+        os.environ['CREFIA_PROFILE_DIR'] = profile_dir
+    try:
+        setup_workdir(workdir)
+        python = sys.executable
+        periods = synthetic_data.month_range('200501', years * 12 + 1)
+        results = []
+
+        # Stage 0: .xls -> .csv (the real sheet layout, under synthetic month names)
+        synthetic_data.write_xls_months(os.path.join(workdir, 'data'), periods[:xls_months])
+        results.append(run_stage('fetch', [python, '0_fetch_data.py'], workdir, xls_months * 550,
+                                 os.path.join(profile_dir, 'fetch.json')))
+        shutil.rmtree(os.path.join(workdir, 'csv'))
+
+        # Stage 1: full load of the synthetic history, all but the last month
+        csv_dir = os.path.join(workdir, 'csv')
+        issuers = synthetic_data.issuer_names(issuer_factor)
+        synthetic_data.write_csv_months(csv_dir, periods[:-1], issuers)
+        results.append(run_stage('load', [python, '1_to_sqlite3.py'], workdir, count_csv_rows(csv_dir),
+                                 os.path.join(profile_dir, 'load.json')))
+
+        # Incremental path: one new month lands
+        synthetic_data.write_csv_months(csv_dir, periods[-1:], issuers, seed=1)
+        results.append(run_stage('reload', [python, '1_to_sqlite3.py'], workdir, len(issuers) * 50,
+                                 os.path.join(profile_dir, 'load.json')))
+
+        # Dashboard query set, one viewer then `viewers` concurrent viewers
+        db_size_mb = round(os.path.getsize(os.path.join(workdir, 'master.db')) / 2**20, 2)
+        for stage, n_viewers in [('dashboard', 1), ('dashboard_concurrent', viewers)]:
+            results.append(run_stage(
+                stage,
+                [python, os.path.abspath(__file__), '--dashboard-queries', os.path.join(workdir, 'master.db'),
+                 '--repeat', str(dashboard_repeat), '--viewers', str(n_viewers)],
+                workdir, dashboard_repeat * n_viewers))
+            results[-1].update(unit='page renders', viewers=n_viewers, db_size_mb=db_size_mb)
+
+        # Cold start: interpreter start, imports, warm-up and the first page render
+        results.append(run_stage('cold_start', [python, os.path.abspath(__file__), '--cold-start'], workdir, 1))
+        results[-1].update(unit='page renders', budget_s=cold_start_budget,
+                           within_budget=results[-1]['wall_s'] <= cold_start_budget)
+
+        # HTTP API under `viewers` concurrent clients
+        results.append(run_stage(
+            'api', [python, os.path.abspath(__file__), '--api', os.path.join(workdir, 'master.db'),
+                    '--repeat', str(dashboard_repeat), '--viewers', str(viewers)],
+            workdir, dashboard_repeat * viewers))
+        # One round requests every metric, for the whole history and since 2015
+        results[-1].update(unit='request rounds', viewers=viewers)
+        return results
+    finally:
+        if keep:
+            print(f'Kept work directory {workdir}', file=sys.stderr)
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+def compare(old_path, new_path):
+    """Print wall time and peak RSS ratios (new / old) per stage."""
+    with open(old_path) as f:
+        old = {r['stage']: r for r in json.load(f)['results']}
+    with open(new_path) as f:
+        new = {r['stage']: r for r in json.load(f)['results']}
+    print(f"{'stage':<12} {'old s':>9} {'new s':>9} {'ratio':>7} {'old MB':>8} {'new MB':>8}")
+    for stage, r in new.items():
+        if stage not in old:
+            continue
+        o = old[stage]
+        ratio = r['wall_s'] / o['wall_s'] if o['wall_s'] else float('nan')
+        print(f"{stage:<12} {o['wall_s']:>9.3f} {r['wall_s']:>9.3f} {ratio:>7.2f} "
+              f"{o['peak_rss_mb']:>8.1f} {r['peak_rss_mb']:>8.1f}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--years', type=int, default=20, help='synthetic history length')
+    parser.add_argument('--issuer-factor', type=int, default=1, help='multiply the issuers in the CSVs')
+    parser.add_argument('--xls-months', type=int, default=24, help='.xls files converted by the fetch stage')
+    parser.add_argument('--repeat', type=int, default=20, help='dashboard query set repetitions')
+    parser.add_argument('--viewers', type=int, default=24, help='concurrent viewers for dashboard_concurrent')
+    parser.add_argument('--cold-start-budget', type=float, default=COLD_START_BUDGET_S,
+                        help='fail if the first dashboard page of a fresh process takes longer (seconds)')
+    parser.add_argument('--output', help='write the JSON results to this file')
+    parser.add_argument('--profile', action='store_true', help='record per-span timings of each stage')
+    parser.add_argument('--keep', action='store_true', help='keep the scratch directory')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='compare two result files')
+    parser.add_argument('--dashboard-queries', metavar='DB', help=argparse.SUPPRESS)
+    parser.add_argument('--cold-start', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--api', metavar='DB', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.dashboard_queries:
+        return dashboard_queries(args.dashboard_queries, args.repeat, args.viewers)
+    if args.cold_start:
+        return cold_start()
+    if args.api:
+        return api_requests(args.api, args.repeat, args.viewers)
+    if args.compare:
+        return compare(*args.compare)
+
+    results = run_benchmarks(args.years, args.issuer_factor, args.xls_months, args.repeat, args.viewers, args.keep,
+                             args.profile, args.cold_start_budget)
+    report = {
+        'commit': git_commit(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'cpus': os.cpu_count(),
+        'params': {'years': args.years, 'issuer_factor': args.issuer_factor,
+                   'xls_months': args.xls_months, 'repeat': args.repeat, 'viewers': args.viewers,
+                   'cold_start_budget_s': args.cold_start_budget},
+        'results': results,
+    }
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text + '\n')
+    print(text)
+
+    over = [r for r in results if r.get('within_budget') is False]
+    for r in over:
+        print(f"{r['stage']}: {r['wall_s']:.2f}s is over the {r['budget_s']:.2f}s budget", file=sys.stderr)
+    return 1 if over else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,113 @@
+"""
+synthetic_data.py
+Generates synthetic monthly CREFIA inputs in the exact crefia_label.csv x issuer layout.
+
+Two kinds of output:
+  - csv/crefia_YYYYMM.csv in the long format written by 0_fetch_data.py, for any
+    number of months and any multiple of the real issuers (random-walk values,
+    with 합계 and the subtotal rows consistent so the load passes crefia_checks.py);
+  - data/카드이용실적_월별_YYYYMM.xls, copies of the real sample sheets under new
+    month names, to exercise 0_fetch_data.py (the sheet layout cannot grow issuers).
+
+Usage:
+    python benchmarks/synthetic_data.py OUT_DIR --years 20 --issuer-factor 1
+"""
+
+import os
+import sys
+import shutil
+import argparse
+
+import numpy as np
+import pandas as pd
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+from crefia_checks import subtotal_matrix
+from crefia_metrics import MARKET_TOTAL, NOT_IN_MARKET_TOTAL
+
+LABEL_PATH = os.path.join(REPO_DIR, 'crefia_label.csv')
+XLS_DIR = os.path.join(REPO_DIR, 'data')
+
+ISSUERS = ['롯데카드', '비씨카드', '비씨카드 기타', '삼성카드', '신한카드', '우리카드',
+           '하나카드', '현대카드', 'KB국민카드', 'NH농협카드', '합계']
+ID_COLUMNS = ['기준년월', '신용체크구분', '개인법인구분', '대분류', '중분류', '소분류']
+
+
+def month_range(start, n_months):
+    """n_months consecutive YYYYMM strings starting at start (YYYYMM)."""
+    return [p.strftime('%Y%m') for p in pd.period_range(pd.Period(start, freq='M'), periods=n_months, freq='M')]
+
+
+def issuer_names(factor=1):
+    """
+    The real issuers, plus (factor - 1) synthetic copies of each card issuer.
+
+    합계 and 비씨카드 기타 are not issuers and stay single columns, as in the
+    published sheets; 합계 is then the sum of every issuer, copies included.
+    """
+    names = list(ISSUERS)
+    for copy in range(1, factor):
+        names += [f'{issuer}_{copy:03d}' for issuer in ISSUERS if issuer not in NOT_IN_MARKET_TOTAL]
+    return names
+
+
+def write_csv_months(csv_dir, periods, issuers, seed=0):
+    """Write one long-format CSV per period. Returns the number of rows written."""
+    os.makedirs(csv_dir, exist_ok=True)
+    df_label = pd.read_csv(LABEL_PATH)
+    rng = np.random.default_rng(seed)
+
+    # Random walk per (label row, issuer), starting at a plausible magnitude
+    level = rng.uniform(1e3, 1e7, size=(len(df_label), len(issuers)))
+    # Subtotal rows are their detail rows plus an unlisted remainder; 합계 is the sum of the issuers
+    subtotals, covered = subtotal_matrix(df_label)
+    members = [issuer not in NOT_IN_MARKET_TOTAL for issuer in issuers]
+    rows = 0
+    for period in periods:
+        level *= rng.normal(1.0, 0.02, size=level.shape)
+        values = np.round(level)
+        values[subtotals] += covered.astype(float) @ values
+        if MARKET_TOTAL in issuers:
+            values[:, issuers.index(MARKET_TOTAL)] = values[:, members].sum(axis=1)
+        df = pd.DataFrame(values, columns=issuers)
+        df = pd.concat([df_label, df], axis=1)
+        df.insert(0, '기준년월', period)
+        df = df.melt(id_vars=ID_COLUMNS, var_name='구분', value_name='value')
+        df.to_csv(os.path.join(csv_dir, f'crefia_{period}.csv'), index=False)
+        rows += len(df)
+    return rows
+
+
+def write_xls_months(data_dir, periods):
+    """Copy the real sample .xls files under the given month names, cycling through them."""
+    os.makedirs(data_dir, exist_ok=True)
+    templates = sorted(f for f in os.listdir(XLS_DIR) if f.endswith('.xls'))
+    for i, period in enumerate(periods):
+        shutil.copyfile(os.path.join(XLS_DIR, templates[i % len(templates)]),
+                        os.path.join(data_dir, f'카드이용실적_월별_{period}.xls'))
+    return len(periods)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('out_dir')
+    parser.add_argument('--years', type=int, default=20)
+    parser.add_argument('--start', default='200501', help='first month (YYYYMM)')
+    parser.add_argument('--issuer-factor', type=int, default=1)
+    parser.add_argument('--xls', action='store_true', help='also write .xls inputs for 0_fetch_data.py')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    periods = month_range(args.start, args.years * 12)
+    rows = write_csv_months(os.path.join(args.out_dir, 'csv'), periods,
+                            issuer_names(args.issuer_factor), seed=args.seed)
+    print(f'Wrote {len(periods)} months, {rows} rows to {args.out_dir}/csv')
+    if args.xls:
+        write_xls_months(os.path.join(args.out_dir, 'data'), periods)
+        print(f'Wrote {len(periods)} .xls files to {args.out_dir}/data')
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,355 @@
+"""
+crefia_api.py
+Read-only HTTP/JSON API over master.db: the issuer x month series of the dashboard, for other tools.
+
+    python crefia_api.py [--host 127.0.0.1] [--port 8502] [--db master.db]
+
+Endpoints (GET):
+  /metrics                 metric names and titles (summary and derived metrics), and the data version
+  /periods                 every 기준년월 with data
+  /metrics/<name>          기준년월 x issuer table of one metric, oldest month first
+      ?start=YYYYMM&end=YYYYMM   inclusive period range (default: everything)
+      &issuers=a,b               issuer columns (default: the dashboard issuers and 합계)
+      &format=json|arrow         columnar JSON (default) or an Arrow IPC stream
+
+Metrics are read from the materialized summary_metric table by primary key,
+never by scanning fact_value. Each metric is read once per data version and
+kept month-indexed (crefia_period.py); encoded responses are cached in memory
+per data version as well. Every response carries an ETag derived from the data
+version and the request, so clients revalidate with If-None-Match and get
+304 Not Modified until the next ingest.
+"""
+
+import os
+import sys
+import json
+import hashlib
+import argparse
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import pandas as pd
+
+from crefia_db import db_filename, read_connection
+from crefia_derived import DERIVED_METRICS, DerivedMetric
+from crefia_metrics import (ISSUERS, SUMMARY_ISSUERS, SUMMARY_METRICS, fetch_metrics, read_data_version,
+                            read_periods, read_summary)
+from crefia_period import PeriodFrame, to_ordinal
+from crefia_profile import span
+
+API_METRICS = {**SUMMARY_METRICS, **DERIVED_METRICS}
+
+DEFAULT_HOST = os.environ.get('CREFIA_API_HOST', '127.0.0.1')
+DEFAULT_PORT = int(os.environ.get('CREFIA_API_PORT', 8502))
+# Encoded responses kept per data version
+MAX_CACHED_RESPONSES = 512
+
+ARROW_TYPE = 'application/vnd.apache.arrow.stream'
+
+
+class BadRequest(ValueError):
+    """Invalid query parameters (HTTP 400)."""
+
+
+class NotFound(LookupError):
+    """Unknown path or metric (HTTP 404)."""
+
+
+def read_table(conn, spec):
+    """
+    기준년월 x issuer table of one metric, from summary_metric.
+
+    When master.db predates summary_metric, summary metrics fall back to the
+    batched query; derived metrics only exist there, so they are NotFound.
+    """
+    try:
+        return read_summary(conn, [spec], SUMMARY_ISSUERS)[spec.name]
+    except pd.errors.DatabaseError:
+        if isinstance(spec, DerivedMetric):
+            raise NotFound(f'derived metric {spec.name!r} is not materialized in this database')
+        df = fetch_metrics(conn, [spec])[spec.name]
+        return df.pivot(index='기준년월', columns='구분', values='value').reindex(columns=list(ISSUERS))
+
+
+def encode_json(obj):
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def columnar(table):
+    """{column: values} of a 기준년월-indexed table, NaN as null."""
+    columns = {'기준년월': table.index.astype(str).tolist()}
+    for issuer in table.columns:
+        values = table[issuer]
+        columns[issuer] = values.astype(object).where(values.notna(), None).tolist()
+    return columns
+
+
+def encode_arrow(table, metadata):
+    import pyarrow as pa
+    batch = pa.Table.from_pandas(table.reset_index(), preserve_index=False)
+    batch = batch.replace_schema_metadata({key: str(value) for key, value in metadata.items()})
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, batch.schema) as writer:
+        writer.write_table(batch)
+    return sink.getvalue().to_pybytes()
+
+
+@contextmanager
+def snapshot(db_path):
+    """A pooled read connection inside one read transaction, and the data version it sees: (conn, version)."""
+    with read_connection(db_path) as conn:
+        conn.execute('BEGIN')
+        try:
+            yield conn, read_data_version(conn)
+        finally:
+            conn.rollback()
+
+
+class ApiCache:
+    """
+    Per-data-version state of the API: month-indexed metric tables and encoded responses.
+
+    The data version is re-read only when master.db (or its WAL file) changes on
+    disk; a new version empties the caches. Every entry is read in one snapshot
+    together with the data version it belongs to, and is only stored while that
+    is still the current version, so a load landing mid-request cannot leave an
+    old-version entry in the new version's cache.
+    """
+
+    def __init__(self, db_path=db_filename, max_responses=MAX_CACHED_RESPONSES):
+        self.db_path = db_path
+        self.max_responses = max_responses
+        self._lock = threading.Lock()
+        self._stamp = None
+        self._version = None
+        self._periods = None
+        self._tables = {}
+        self._responses = OrderedDict()
+
+    def _db_stamp(self):
+        paths = [self.db_path, self.db_path + '-wal']
+        return tuple((os.stat(path).st_ino, os.stat(path).st_mtime_ns) for path in paths if os.path.exists(path))
+
+    def _set_version(self, version):
+        """Make version current (emptying the caches if it is new); caller holds the lock."""
+        if version != self._version:
+            self._periods, self._tables, self._responses = None, {}, OrderedDict()
+            self._version = version
+
+    def data_version(self):
+        stamp = self._db_stamp()
+        with self._lock:
+            if stamp == self._stamp:
+                return self._version
+        with snapshot(self.db_path) as (_, version):
+            pass
+        with self._lock:
+            self._set_version(version)
+            self._stamp = stamp
+            return self._version
+
+    def _store(self, version, store):
+        """Run store() under the lock if version is the current one (a newer version moves the cache on)."""
+        with self._lock:
+            if self._version is None or version > self._version:
+                self._set_version(version)
+            if version == self._version:
+                store()
+
+    def periods(self):
+        """(data version, every 기준년월 with data)."""
+        with self._lock:
+            if self._periods is not None:
+                return self._version, self._periods
+        with snapshot(self.db_path) as (conn, version):
+            periods = read_periods(conn)
+        self._store(version, lambda: setattr(self, '_periods', periods))
+        return version, periods
+
+    def table(self, name):
+        """(data version, PeriodFrame of the metric's table, oldest month first)."""
+        with self._lock:
+            if name in self._tables:
+                return self._version, self._tables[name]
+        with span('api/read_table'), snapshot(self.db_path) as (conn, version):
+            frame = PeriodFrame(read_table(conn, API_METRICS[name]).sort_index())
+        self._store(version, lambda: self._tables.__setitem__(name, frame))
+        return version, frame
+
+    def response(self, key, build):
+        """
+        Cached (data version, content type, body) for key, built by build() on a miss.
+
+        build() returns the same triple, with the version of the data it was built from.
+        """
+        with self._lock:
+            if key in self._responses:
+                self._responses.move_to_end(key)
+                return self._responses[key]
+        result = build()
+
+        def store():
+            self._responses[key] = result
+            while len(self._responses) > self.max_responses:
+                self._responses.popitem(last=False)
+        self._store(result[0], store)
+        return result
+
+
+def parse_query(query):
+    """(start, end, issuers, format) from the query string, as month ordinals and lists."""
+    params = {key: values[-1] for key, values in parse_qs(query).items()}
+    unknown = set(params) - {'start', 'end', 'issuers', 'format'}
+    if unknown:
+        raise BadRequest(f'unknown parameter(s): {sorted(unknown)}')
+    try:
+        start = to_ordinal(params['start']) if 'start' in params else None
+        end = to_ordinal(params['end']) if 'end' in params else None
+    except ValueError:
+        raise BadRequest('start and end are months as YYYYMM')
+    if start is not None and end is not None and start > end:
+        raise BadRequest('start is after end')
+    issuers = [issuer for issuer in params['issuers'].split(',') if issuer] if 'issuers' in params else None
+    fmt = params.get('format', 'json')
+    if fmt not in ('json', 'arrow'):
+        raise BadRequest("format is 'json' or 'arrow'")
+    return start, end, issuers, fmt
+
+
+def metric_response(cache, name, query):
+    if name not in API_METRICS:
+        raise NotFound(f'unknown metric {name!r}')
+    start, end, issuers, fmt = parse_query(query)
+    data_version, frame = cache.table(name)
+    table = frame.slice(start, end)
+    if issuers is not None:
+        missing = [issuer for issuer in issuers if issuer not in table.columns]
+        if missing:
+            raise BadRequest(f'unknown issuer(s): {missing}')
+        table = table[issuers]
+    metadata = {'metric': name, 'title': API_METRICS[name].title, 'data_version': data_version}
+    if fmt == 'arrow':
+        return data_version, ARROW_TYPE, encode_arrow(table, metadata)
+    return data_version, 'application/json', encode_json({**metadata, 'columns': columnar(table)})
+
+
+def route(cache, path, query, data_version):
+    """(data version, content type, body) of a GET request."""
+    if path == '/metrics':
+        return data_version, 'application/json', encode_json({
+            'data_version': data_version,
+            'metrics': [{'name': name, 'title': spec.title} for name, spec in API_METRICS.items()],
+        })
+    if path == '/periods':
+        data_version, periods = cache.periods()
+        return data_version, 'application/json', encode_json({'data_version': data_version, 'periods': periods})
+    if path.startswith('/metrics/'):
+        return metric_response(cache, path[len('/metrics/'):], query)
+    raise NotFound(f'unknown path {path!r}')
+
+
+def request_key(path, query):
+    """
+    Cache and ETag key of a request: the path, and for a metric its parsed query.
+
+    Parsed rather than raw, so requests that parse_query reads the same (parameter
+    order, repeated parameters, empty issuers) share a key and others never do.
+    """
+    if path.startswith('/metrics/'):
+        return repr((path, *parse_query(query)))
+    return path
+
+
+def make_etag(data_version, key):
+    return f'"{data_version}-{hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]}"'
+
+
+def etag_matches(if_none_match, etag):
+    """True if an If-None-Match header ('*' or a list of ETags, weak or strong) matches etag."""
+    if if_none_match is None:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(',')]
+    # If-None-Match uses the weak comparison: W/"x" matches "x"
+    return '*' in tags or etag in (tag[2:] if tag.startswith('W/') else tag for tag in tags)
+
+
+class ApiHandler(BaseHTTPRequestHandler):
+    server_version = 'crefia-api'
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are separate writes; don't let them wait on delayed ACKs over keep-alive
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        cache = self.server.cache
+        url = urlsplit(self.path)
+        try:
+            key = request_key(url.path, url.query)
+            data_version = cache.data_version()
+            if etag_matches(self.headers.get('If-None-Match'), make_etag(data_version, key)):
+                self.send_response(304)
+                self.send_header('ETag', make_etag(data_version, key))
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            # Labelled with the version the body was read from, which is newer if a load just landed
+            data_version, content_type, body = cache.response(
+                key, lambda: route(cache, url.path, url.query, data_version))
+        except BadRequest as e:
+            return self.send_error_json(400, str(e))
+        except NotFound as e:
+            return self.send_error_json(404, str(e))
+
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', make_etag(data_version, key))
+        # Cacheable, but revalidated on every use (the data changes with each ingest)
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_error_json(self, status, message):
+        body = encode_json({'error': message})
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+def make_server(host=DEFAULT_HOST, port=DEFAULT_PORT, db_path=db_filename, verbose=False):
+    """A ThreadingHTTPServer serving the API (call serve_forever() on it)."""
+    server = ThreadingHTTPServer((host, port), ApiHandler)
+    server.daemon_threads = True
+    server.cache = ApiCache(db_path)
+    server.verbose = verbose
+    return server
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default=DEFAULT_HOST, help='address to listen on')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT, help='port to listen on')
+    parser.add_argument('--db', default=db_filename, help='database to serve')
+    parser.add_argument('--verbose', action='store_true', help='log every request')
+    args = parser.parse_args(argv)
+
+    server = make_server(args.host, args.port, args.db, args.verbose)
+    print(f'Serving {args.db} on http://{args.host}:{server.server_address[1]}/metrics', file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
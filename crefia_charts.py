@@ -0,0 +1,73 @@
+"""
+crefia_charts.py
+Issuer line charts of the dashboard, shared by the Streamlit app and the static export.
+
+line_chart() builds the Altair chart of a (기준년월, 구분, value) frame after
+bounding it with crefia_resample; the same frame gives the same Vega-Lite spec
+whether it is drawn live or pre-rendered by crefia_export.py.
+
+Altair is only imported by the first line_chart() call, so a dashboard page
+served entirely from the export never loads it.
+"""
+
+from crefia_profile import span
+from crefia_resample import RESOLUTIONS, resample
+
+# Design Settings
+CI_color = {
+    '신한카드': '#0046FF',  # Shinhan Blue
+    '현대카드': '#222222',  # 현대 블랙
+    '우리카드': '#20C4F4',  # 우리 스카이 블루
+    '삼성카드': '#1428A0',  # 삼성 블루
+    '롯데카드': '#ED1C24',  # 롯데 레드
+    '하나카드': '#1DB2A5',  # 하나 민트
+    'KB국민카드': '#FFBC00', # KB Yellow Positive
+}
+
+# Caption text for rolled-up charts
+RESOLUTION_LABELS = {'quarter': '분기', 'year': '연도'}
+ROLLUP_LABELS = {'last': '기말 기준', 'mean': '월평균', 'sum': '합계'}
+# Point markers are drawn only up to this many points per line
+MARKER_LIMIT = 60
+
+
+def line_chart(df, y_title, rollup='last'):
+    """Issuer line chart of a (기준년월, 구분, value) frame, rolled up or thinned to a bounded size. Returns (chart, resolution)."""
+    with span('resample', rows=len(df)):
+        df_chart, resolution = resample(df, rollup)
+    n_points = df_chart['기준일'].nunique()
+
+    with span('altair_build', rows=len(df_chart)):
+        import altair as alt
+
+        # Build color scale for Altair using CI_color
+        CI_color_scale = alt.Scale(domain=list(CI_color.keys()), range=list(CI_color.values()))
+
+        # Add Highlight Points
+        highlight = alt.selection_point(fields=['구분'], bind='legend', nearest=True)
+
+        # Draw a Chart
+        chart = alt.Chart(df_chart
+            ).mark_line(point={'size':75} if n_points <= MARKER_LIMIT else False
+            ).encode(
+                x=alt.X('기준일:T', title='기준년월',
+                        axis=alt.Axis(format=RESOLUTIONS[resolution][1], labelAngle=270, labelOverlap=True)),
+                y=alt.Y('value:Q', title=y_title, scale=alt.Scale()),
+                color=alt.Color('구분:N', scale=CI_color_scale, title=None, legend=alt.Legend(orient='bottom')),
+                opacity=alt.condition(highlight, alt.value(1), alt.value(0.1))
+            ).add_params(
+                highlight
+            ).interactive(
+                # Pan / Zoom
+            ).properties(
+                # Width / Height
+                height=400
+            )
+    return chart, resolution
+
+
+def chart_caption(resolution, rollup='last'):
+    caption = "ℹ️ Shift+Click legend to multi-select lines."
+    if resolution in RESOLUTION_LABELS:
+        caption += f" 기간이 길어 {RESOLUTION_LABELS[resolution]}별 {ROLLUP_LABELS[rollup]}으로 표시합니다."
+    return caption
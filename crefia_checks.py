@@ -0,0 +1,262 @@
+"""
+crefia_checks.py
+Consistency and anomaly checks of the loaded months, run by 1_to_sqlite3.py before every commit.
+
+Every check is one vectorized pass over a crefia_cube.Cube (period x label row x issuer):
+  issuer_total  the issuers (except 비씨카드 기타) add up to the published 합계 column
+  subtotal      details exceed subtotal: the detail rows of a subtotal row (소분류 or
+                중분류 '합계') add up to more than it, in the same month and issuer. One-sided:
+                the subtotals also cover items that have no row, so details below them are fine
+  zscore        the month-over-month change of each (label row, issuer) series is within
+                ZSCORE_LIMIT standard deviations of its changes over the previous ZSCORE_WINDOW months
+
+issuer_total findings are errors: the load is rolled back. subtotal and zscore
+findings are warnings (the published sheets carry a few legitimate ones, e.g.
+비씨카드 in the months it started issuing and one-unit rounding in 신규회원수);
+CREFIA_CHECKS_STRICT=1 makes them block the load as well.
+
+The report is a compact JSON (REPORT_PATH): counts per check and the largest
+findings, with the time taken. To check a whole database:
+    python crefia_checks.py [master.db]
+"""
+
+import os
+import sys
+import json
+import time
+
+import numpy as np
+import pandas as pd
+
+from crefia_db import connect_read_only, db_filename
+from crefia_metrics import MARKET_TOTAL, NOT_IN_MARKET_TOTAL
+from crefia_period import to_ordinal, to_period
+from crefia_profile import span
+from crefia_stream import load_cube
+
+REPORT_PATH = os.environ.get('CREFIA_CHECKS_REPORT', 'ingest_checks.json')
+STRICT = os.environ.get('CREFIA_CHECKS_STRICT', '') not in ('', '0')
+
+SUBTOTAL = '합계'
+# Sums of values rounded to whole units may be off by rounding
+ABS_TOLERANCE = 1.0
+REL_TOLERANCE = 1e-6
+# z-score of the month-over-month change against the trailing window of changes
+ZSCORE_WINDOW = 36
+ZSCORE_MIN_HISTORY = 12
+ZSCORE_LIMIT = 6.0
+# Findings listed per check in the report (the counts cover all of them)
+TOP_FINDINGS = 10
+
+SEVERITY = {'issuer_total': 'error', 'subtotal': 'warning', 'zscore': 'warning'}
+# What a finding of each check means, as written to the report
+DESCRIPTIONS = {
+    'issuer_total': 'sum of the issuers (except 비씨카드 기타) differs from 합계',
+    'subtotal': 'details exceed subtotal (one-sided: details below their subtotal are not findings)',
+    'zscore': f'month-over-month change beyond {ZSCORE_LIMIT:g} standard deviations '
+              f'of the previous {ZSCORE_WINDOW} changes',
+}
+# Names of the two values of a finding: (what was found, what it was checked against)
+FIELDS = {
+    'issuer_total': ('issuer_sum', 'total'),
+    'subtotal': ('details', 'subtotal'),
+    'zscore': ('value', 'expected'),
+}
+
+
+class ConsistencyError(Exception):
+    """A load failed its blocking checks; .report holds the findings."""
+
+    def __init__(self, report):
+        self.report = report
+        super().__init__('; '.join(summary_lines(report)))
+
+
+def subtotal_matrix(labels):
+    """
+    Boolean matrix (subtotal row, label row) of the detail rows each subtotal row covers.
+
+    A 소분류 '합계' row covers the other rows of its 중분류; a 중분류 '합계' row covers
+    the rows of its 대분류 that are not subtotals themselves (within the same
+    신용체크구분 / 개인법인구분). Returns (positions of the subtotal rows, matrix).
+    """
+    is_total = {column: (labels[column] == SUBTOTAL).to_numpy() for column in ('중분류', '소분류')}
+    levels = [('소분류', ['신용체크구분', '개인법인구분', '대분류', '중분류'], ~is_total['소분류']),
+              ('중분류', ['신용체크구분', '개인법인구분', '대분류'], ~is_total['중분류'] & ~is_total['소분류'])]
+    rows, matrix = [], []
+    for column, group, details in levels:
+        key = pd.MultiIndex.from_frame(labels[group])
+        for position in np.flatnonzero(is_total[column]):
+            covered = (key == key[position]) & details
+            if covered.any():
+                rows.append(position)
+                matrix.append(covered)
+    return np.array(rows, dtype=int), np.array(matrix, dtype=bool).reshape(len(rows), len(labels))
+
+
+def tolerance(expected):
+    return ABS_TOLERANCE + REL_TOLERANCE * np.abs(expected)
+
+
+def findings(cube, mask, p, values, expected, fields, rows=None, issuers=None, extra=None):
+    """
+    Count and the TOP_FINDINGS largest deviations of a violation mask over (period, row, issuer).
+
+    fields names values and expected in the report (FIELDS). p, rows and issuers
+    map the mask's axes to positions in the cube (default: the cube's own axes).
+    """
+    where = np.nonzero(mask)
+    deviation = np.abs(values[where] - expected[where])
+    order = np.argsort(-deviation, kind='stable')[:TOP_FINDINGS]
+    labels = cube.labels.to_numpy()
+    top = []
+    for k in order:
+        i_p, i_r, i_i = where[0][k], where[1][k], where[2][k]
+        finding = {
+            '기준년월': cube.periods[p[i_p]],
+            'label': '/'.join(labels[i_r if rows is None else rows[i_r]]),
+            '구분': cube.issuers[i_i if issuers is None else issuers[i_i]],
+            fields[0]: float(values[i_p, i_r, i_i]),
+            fields[1]: float(expected[i_p, i_r, i_i]),
+        }
+        if extra is not None:
+            finding.update({name: round(float(array[i_p, i_r, i_i]), 2) for name, array in extra.items()})
+        top.append(finding)
+    return {'count': int(len(where[0])), 'top': top}
+
+
+def check_issuer_total(cube, p):
+    """Issuers (except NOT_IN_MARKET_TOTAL) vs the 합계 column, for the periods at positions p."""
+    if MARKET_TOTAL not in cube.issuers:
+        return {'count': 0, 'top': []}
+    values = cube.values[p]
+    members = ~cube.issuers.isin(NOT_IN_MARKET_TOTAL)
+    total_position = cube.issuers.get_loc(MARKET_TOTAL)
+    total = values[:, :, [total_position]]
+    issuer_sum = np.nansum(values[:, :, members], axis=2, keepdims=True)
+    reported = ~np.isnan(values[:, :, members]).all(axis=2, keepdims=True)
+    mask = ~np.isnan(total) & reported & (np.abs(issuer_sum - total) > tolerance(total))
+    return findings(cube, mask, p, issuer_sum, total, FIELDS['issuer_total'], issuers=[total_position])
+
+
+def check_subtotal(cube, p):
+    """Details exceed subtotal: subtotal rows whose detail rows add up to more, per period and issuer (one-sided)."""
+    rows, matrix = subtotal_matrix(cube.labels)
+    if not len(rows):
+        return {'count': 0, 'top': []}
+    values = cube.values[p]
+    # (period, subtotal, issuer) sums of the covered rows in one contraction
+    details = np.einsum('sl,pli->psi', matrix.astype(float), np.nan_to_num(values))
+    reported = np.einsum('sl,pli->psi', matrix.astype(float), (~np.isnan(values)).astype(float)) > 0
+    subtotal = values[:, rows, :]
+    mask = ~np.isnan(subtotal) & reported & (details - subtotal > tolerance(subtotal))
+    return findings(cube, mask, p, details, subtotal, FIELDS['subtotal'], rows=rows)
+
+
+def check_zscore(cube, p):
+    """z-score of each series' month-over-month change against its trailing ZSCORE_WINDOW changes."""
+    changes = np.diff(cube.values, axis=0)
+    # Running sums over the period axis: the window statistics of every period by subtraction
+    present = ~np.isnan(changes)
+    x = np.where(present, changes, 0.0)
+    zero = np.zeros((1,) + x.shape[1:])
+    s1 = np.concatenate([zero, np.cumsum(x, axis=0)])
+    s2 = np.concatenate([zero, np.cumsum(x * x, axis=0)])
+    n = np.concatenate([zero, np.cumsum(present, axis=0)])
+
+    # The change into period p is changes[p - 1]; its window is the ZSCORE_WINDOW changes before it
+    p = p[p >= 1]
+    t = p - 1
+    lo = np.maximum(t - ZSCORE_WINDOW, 0)
+    count = n[t] - n[lo]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = (s1[t] - s1[lo]) / count
+        std = np.sqrt(np.maximum((s2[t] - s2[lo]) / count - mean * mean, 0))
+        z = (changes[t] - mean) / std
+    mask = (count >= ZSCORE_MIN_HISTORY) & (std > 0) & (np.abs(z) > ZSCORE_LIMIT)
+    return findings(cube, mask, p, cube.values[p], cube.values[t] + mean, FIELDS['zscore'], extra={'z': z})
+
+
+CHECKS = {
+    'issuer_total': check_issuer_total,
+    'subtotal': check_subtotal,
+    'zscore': check_zscore,
+}
+
+
+def check_cube(cube, periods=None, strict=STRICT):
+    """Run CHECKS over the cube's periods (or the given 기준년월 only, the rest being history). Returns the report."""
+    start = time.perf_counter()
+    if periods is None:
+        p = np.arange(len(cube.periods))
+    else:
+        p = np.flatnonzero(cube.periods.isin([str(period) for period in periods]))
+    report = {'periods': len(p), 'first': cube.periods[p[0]] if len(p) else None,
+              'last': cube.periods[p[-1]] if len(p) else None, 'cells': int(len(p) * np.prod(cube.shape[1:]))}
+    report['checks'] = {}
+    for name, check in CHECKS.items():
+        with span(f'check_{name}'):
+            result = check(cube, p)
+        report['checks'][name] = {'severity': SEVERITY[name], 'description': DESCRIPTIONS[name], **result}
+    blocking = {'error', 'warning'} if strict else {'error'}
+    report['blocked'] = any(result['count'] for result in report['checks'].values()
+                            if result['severity'] in blocking)
+    report['elapsed_s'] = round(time.perf_counter() - start, 4)
+    return report
+
+
+def check_loaded(conn, periods=None, strict=STRICT):
+    """
+    Check the given 기준년월 of fact_value (None: every month), on the caller's connection.
+
+    Only the checked months and the ZSCORE_WINDOW months before them are read.
+    Raises ConsistencyError if a blocking check fails; returns the report otherwise.
+    """
+    start = time.perf_counter()
+    if periods is None:
+        first = last = None
+    else:
+        periods = sorted(str(period) for period in periods)
+        first = int(to_period(to_ordinal(periods[0]) - ZSCORE_WINDOW - 1))
+        last = int(periods[-1])
+    with span('read_cube'):
+        cube = load_cube(conn, start=first, end=last)
+    report = check_cube(cube, periods, strict)
+    report['elapsed_s'] = round(time.perf_counter() - start, 4)
+    report['s_per_month'] = round(report['elapsed_s'] / max(report['periods'], 1), 4)
+    if report['blocked']:
+        raise ConsistencyError(report)
+    return report
+
+
+def write_report(report, path=REPORT_PATH):
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=1)
+
+
+def summary_lines(report):
+    lines = []
+    for name, result in report['checks'].items():
+        if result['count']:
+            worst = result['top'][0]
+            found, against = FIELDS[name]
+            lines.append(f"{name} ({result['severity']}, {result['description']}): {result['count']} finding(s), "
+                         f"e.g. {worst['기준년월']} {worst['label']} {worst['구분']}: "
+                         f"{found} {worst[found]:,.0f}, {against} {worst[against]:,.0f}")
+    return lines
+
+
+if __name__ == '__main__':
+    conn = connect_read_only(sys.argv[1] if len(sys.argv) > 1 else db_filename, immutable=False)
+    try:
+        report = check_loaded(conn)
+    except ConsistencyError as e:
+        report = e.report
+    finally:
+        conn.close()
+    write_report(report)
+    print(f"Checked {report['periods']} month(s) ({report['first']}-{report['last']}) "
+          f"in {report['elapsed_s']:.2f}s: {'blocked' if report['blocked'] else 'ok'}")
+    for line in summary_lines(report):
+        print('  ' + line)
+    sys.exit(1 if report['blocked'] else 0)
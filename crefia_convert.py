@@ -0,0 +1,250 @@
+"""
+crefia_convert.py
+Converts a monthly CREFIA .xls sheet into the long-format crefia_YYYYMM.csv used by the loader.
+
+Kept in its own module so that worker processes of 0_fetch_data.py can import it.
+
+Before anything is written the sheet is matched to the layout crefia_label.csv
+was written for (see crefia_layout.py); a sheet whose rows moved is converted
+through the resulting row mapping, one that can't be matched raises LayoutError.
+
+The conversion streams: cells are read straight from the xlrd sheet and written
+as long-format rows, one issuer column at a time, without building a wide
+DataFrame or melting it. The output is the same as the former
+read_excel -> concat -> to_numeric -> melt -> to_csv path, byte for byte.
+
+Conversions are cached by content: csv/convert_manifest.json records, per .xls
+file, its SHA-256, the SHA-256 of crefia_label.csv and CONVERTER_VERSION at the
+time it was converted. A file is reconverted only when one of them changes (or
+its CSV is missing). A CSV already on disk that holds the same data as the
+conversion, as the loader reads it, is kept as it is (e.g. the tracked CSVs on a
+fresh clone, which has no manifest yet); a rewritten CSV keeps its UTF-8 BOM if
+it had one. The CSVs written are appended to csv/changed.json, which
+1_to_sqlite3.py reads to load just those months and clears once they are loaded.
+"""
+
+import os
+import csv
+import json
+import math
+import time
+import codecs
+import itertools
+
+import xlrd
+
+from crefia_layout import FIRST_VALUE_COLUMN, file_sha256, resolve_layout
+from crefia_profile import profiled, span
+
+# Bump whenever a change to this module changes the CSVs it writes
+CONVERTER_VERSION = 1
+
+manifest_path = os.path.join('csv', 'convert_manifest.json')
+changed_path = os.path.join('csv', 'changed.json')
+
+ID_COLUMNS = ['기준년월', '신용체크구분', '개인법인구분', '대분류', '중분류', '소분류']
+OUTPUT_COLUMNS = ID_COLUMNS + ['구분', 'value']
+
+# Label frame and reference layout shared by every conversion in a worker process (see init_worker)
+_df_label = None
+_reference = None
+
+
+def init_worker(df_label, reference=None):
+    """Process pool initializer: receive crefia_label.csv and crefia_layout.json once per worker."""
+    global _df_label, _reference
+    _df_label = df_label
+    _reference = reference
+
+
+def period_from_filename(xls_file):
+    """Extract YYYYMM from the xls filename (it's after the last underscore)."""
+    return os.path.basename(xls_file).split('_')[-1].replace('.xls', '')
+
+
+def to_number(cell):
+    """Numeric value of a cell, as pd.to_numeric(errors='coerce') gives it after read_excel."""
+    if cell.ctype == xlrd.XL_CELL_NUMBER:
+        value = cell.value
+        return int(value) if value.is_integer() else value
+    if cell.ctype == xlrd.XL_CELL_TEXT:
+        text = cell.value.strip()
+        for parse in (int, float):
+            try:
+                return parse(text)
+            except ValueError:
+                pass
+    return math.nan
+
+
+def format_value(value, integral):
+    """CSV text of a value; melt gives the whole sheet one dtype, so ints only if every value is one."""
+    if integral:
+        return str(value)
+    return '' if math.isnan(value) else repr(float(value))
+
+
+def loaded_value(text):
+    """A CSV value as the loader reads it (pd.to_numeric(errors='coerce')): a float, or None."""
+    try:
+        value = float(text)
+    except ValueError:
+        return None
+    return None if math.isnan(value) else value
+
+
+def same_data(path, other_path):
+    """True if both long-format CSVs hold the same rows and values, ignoring BOM and number formatting."""
+    with open(path, newline='', encoding='utf-8-sig') as f, open(other_path, newline='', encoding='utf-8-sig') as g:
+        for row, other in itertools.zip_longest(csv.reader(f), csv.reader(g)):
+            if row is None or other is None or row[:-1] != other[:-1]:
+                return False
+            if row[-1] != other[-1] and loaded_value(row[-1]) != loaded_value(other[-1]):
+                return False
+    return True
+
+
+def has_bom(path):
+    with open(path, 'rb') as f:
+        return f.read(len(codecs.BOM_UTF8)) == codecs.BOM_UTF8
+
+
+def iter_long_rows(sheet, period, label_rows, row_map=None):
+    """
+    Yield long-format rows (OUTPUT_COLUMNS order) for one sheet.
+
+    label_rows: (신용체크구분, 개인법인구분, 대분류, 중분류, 소분류) tuples, one per label row.
+    row_map: the sheet data row of each label row (None: the same position).
+    Rows are produced cell by cell in melt order (issuer column by issuer column),
+    so nothing beyond the xlrd sheet itself is held in memory.
+    """
+    header = sheet.row_values(0)
+    if row_map is None:
+        row_map = range(min(len(label_rows), sheet.nrows - 1))
+
+    def cells():
+        for col in range(FIRST_VALUE_COLUMN, sheet.ncols):
+            for label, row in enumerate(row_map):
+                yield label, row + 1, col
+
+    # Cheap first pass over the cells to pick the value format, as pandas would
+    integral = all(isinstance(to_number(sheet.cell(row, col)), int) for _, row, col in cells())
+    for label, row, col in cells():
+        value = format_value(to_number(sheet.cell(row, col)), integral)
+        yield (period, *label_rows[label], header[col], value)
+
+
+@profiled()
+def convert_xls(xls_path, csv_path, df_label=None, layout=None):
+    """
+    Convert one .xls file to csv_path.
+
+    layout: (fingerprint, row_map) already known for this file; if None the sheet is
+    matched to the reference layout first. An existing csv_path with the same data is
+    left untouched; otherwise it is replaced, keeping its BOM.
+    Returns (xls file name, rows, seconds, (fingerprint, row_map), whether csv_path was written).
+    """
+    if df_label is None:
+        df_label = _df_label
+    start = time.perf_counter()
+    name = os.path.basename(xls_path)
+
+    # Replace first five columns with crefia_label.csv columns
+    label_rows = list(df_label[ID_COLUMNS[1:]].itertuples(index=False, name=None))
+
+    with span('open_workbook'):
+        book = xlrd.open_workbook(xls_path, on_demand=True)
+    try:
+        with span('load_sheet'):
+            sheet = book.sheet_by_index(0)
+        if layout is None:
+            with span('resolve_layout'):
+                layout = resolve_layout(sheet, _reference, name)
+        rows = 0
+        exists = os.path.exists(csv_path)
+        encoding = 'utf-8-sig' if exists and has_bom(csv_path) else 'utf-8'
+        # Written under a temporary name, so an interrupted run never leaves a partial CSV
+        with span('write_csv') as s, open(csv_path + '.tmp', 'w', newline='', encoding=encoding) as f:
+            writer = csv.writer(f, lineterminator=os.linesep)
+            writer.writerow(OUTPUT_COLUMNS)
+            for row in iter_long_rows(sheet, period_from_filename(xls_path), label_rows, layout[1]):
+                writer.writerow(row)
+                rows += 1
+            s.rows = rows
+        with span('compare_csv'):
+            written = not (exists and same_data(csv_path + '.tmp', csv_path))
+        if written:
+            os.replace(csv_path + '.tmp', csv_path)
+        else:
+            os.remove(csv_path + '.tmp')
+    finally:
+        book.release_resources()
+    return name, rows, time.perf_counter() - start, tuple(layout), written
+
+
+def read_json(path, default):
+    try:
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return default
+
+
+def write_json(obj, path):
+    """Write obj to path atomically."""
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(obj, f, ensure_ascii=False, indent=1)
+    os.replace(path + '.tmp', path)
+
+
+def load_manifest(path=manifest_path):
+    """The conversion manifest: {'files': {xls file name: entry}}."""
+    return read_json(path, {'files': {}})
+
+
+def save_manifest(manifest, path=manifest_path):
+    write_json(manifest, path)
+
+
+def source_sha256(manifest, xls_path):
+    """SHA-256 of xls_path, taken from the manifest when its size and modification time are unchanged."""
+    entry = manifest['files'].get(os.path.basename(xls_path))
+    st = os.stat(xls_path)
+    if entry and entry['size'] == st.st_size and entry['mtime_ns'] == st.st_mtime_ns:
+        return entry['xls_sha256']
+    return file_sha256(xls_path)
+
+
+def is_converted(manifest, xls_path, xls_sha256, label_sha256, csv_path):
+    """True if csv_path was converted from this very content, with this crefia_label.csv and converter."""
+    entry = manifest['files'].get(os.path.basename(xls_path))
+    return (entry is not None
+            and entry['xls_sha256'] == xls_sha256
+            and entry['label_sha256'] == label_sha256
+            and entry['converter_version'] == CONVERTER_VERSION
+            and entry['csv'] == os.path.basename(csv_path)
+            and os.path.exists(csv_path))
+
+
+def record_conversion(manifest, xls_path, xls_sha256, label_sha256, csv_path):
+    st = os.stat(xls_path)
+    manifest['files'][os.path.basename(xls_path)] = {
+        'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'xls_sha256': xls_sha256,
+        'label_sha256': label_sha256, 'converter_version': CONVERTER_VERSION, 'csv': os.path.basename(csv_path),
+    }
+
+
+def read_changed(path=changed_path):
+    """CSV file names converted since the last load, or None if there is no record."""
+    return read_json(path, None)
+
+
+def add_changed(csv_files, path=changed_path):
+    """Add csv_files to the CSVs waiting to be loaded."""
+    write_json(sorted(set(read_changed(path) or []) | set(csv_files)), path)
+
+
+def clear_changed(path=changed_path):
+    if os.path.exists(path):
+        os.remove(path)
@@ -0,0 +1,138 @@
+"""
+crefia_cube.py
+Dense in-memory cube of the CREFIA data: a float array shaped (period, label row, issuer).
+
+The long format repeats six strings for every number. The cube keeps each axis
+once (periods, the label rows of crefia_label.csv, issuers) and the values in a
+single NumPy array, so a month costs label rows x issuers x 8 bytes.
+Slicing by any combination of dimensions returns NumPy views where possible,
+and pandas frames are only built on request.
+"""
+
+import numpy as np
+import pandas as pd
+
+LABEL_COLUMNS = ['신용체크구분', '개인법인구분', '대분류', '중분류', '소분류']
+
+
+class Cube:
+    """
+    values  : ndarray (n_periods, n_labels, n_issuers), NaN where missing
+    periods : pd.Index of 기준년월
+    labels  : DataFrame of the label rows (LABEL_COLUMNS), one per label axis position
+    issuers : pd.Index of 구분
+    """
+
+    def __init__(self, values, periods, labels, issuers):
+        self.values = values
+        self.periods = pd.Index(periods, name='기준년월')
+        self.labels = labels.reset_index(drop=True)
+        self.issuers = pd.Index(issuers, name='구분')
+
+    @classmethod
+    def from_long(cls, df, labels=None):
+        """Build a cube from long-format rows (기준년월, LABEL_COLUMNS, 구분, value)."""
+        if labels is None:
+            labels = df[LABEL_COLUMNS].drop_duplicates()
+        labels = labels[LABEL_COLUMNS].reset_index(drop=True)
+        periods = pd.Index(sorted(df['기준년월'].astype(str).unique()))
+        issuers = pd.Index(pd.unique(df['구분']))
+
+        # Integer codes for each axis, then one scatter into the dense array
+        label_index = pd.MultiIndex.from_frame(labels)
+        label_codes = label_index.get_indexer(pd.MultiIndex.from_frame(df[LABEL_COLUMNS]))
+        period_codes = periods.get_indexer(df['기준년월'].astype(str))
+        issuer_codes = issuers.get_indexer(df['구분'])
+        known = label_codes >= 0
+
+        values = np.full((len(periods), len(labels), len(issuers)), np.nan)
+        values[period_codes[known], label_codes[known], issuer_codes[known]] = \
+            df['value'].to_numpy(dtype=float)[known]
+        return cls(values, periods, labels, issuers)
+
+    @property
+    def shape(self):
+        return self.values.shape
+
+    @property
+    def nbytes(self):
+        return self.values.nbytes
+
+    def label_mask(self, **criteria):
+        """Boolean mask over the label axis, e.g. label_mask(대분류='회원수', 개인법인구분='개인')."""
+        mask = np.ones(len(self.labels), dtype=bool)
+        for col, value in criteria.items():
+            if isinstance(value, (list, tuple, set)):
+                mask &= self.labels[col].isin(value).to_numpy()
+            else:
+                mask &= (self.labels[col] == value).to_numpy()
+        return mask
+
+    def _axis_selector(self, index, selection):
+        """Slice (keeps a view) for a single value or a range of labels, positions for a list."""
+        if selection is None:
+            return slice(None)
+        if isinstance(selection, slice):
+            return index.slice_indexer(selection.start, selection.stop)
+        if isinstance(selection, (list, tuple, set, np.ndarray, pd.Index)):
+            return np.flatnonzero(index.isin(list(selection)))
+        position = index.get_loc(selection)
+        return slice(position, position + 1)
+
+    def select(self, periods=None, issuers=None, **criteria):
+        """
+        Sub-cube for the given periods, issuers and label criteria.
+
+        periods / issuers: a single value, a list, or a slice of labels (inclusive),
+        e.g. periods=slice('202401', '202412'). Criteria are label columns, e.g.
+        대분류='회원수' or 중분류=['신규회원수(월중)', '해지회원수(월중)'].
+        Single values, slices and contiguous label rows keep views of the array.
+        """
+        p = self._axis_selector(self.periods, periods)
+        i = self._axis_selector(self.issuers, issuers)
+        l = slice(None)
+        if criteria:
+            positions = np.flatnonzero(self.label_mask(**criteria))
+            # A contiguous block of label rows can stay a view
+            if len(positions) and positions[-1] - positions[0] + 1 == len(positions):
+                l = slice(positions[0], positions[-1] + 1)
+            else:
+                l = positions
+
+        # Index one axis at a time: mixing several integer arrays would broadcast them together
+        values = self.values[p][:, l][:, :, i]
+        return Cube(values, self.periods[p], self.labels.iloc[l], self.issuers[i])
+
+    def frame(self, label=None):
+        """
+        Period x issuer DataFrame for one label position (default: the only label left),
+        sharing memory with the cube.
+        """
+        if label is None:
+            if len(self.labels) != 1:
+                raise ValueError(f'frame() needs a label position, the cube has {len(self.labels)} label rows')
+            label = 0
+        return pd.DataFrame(self.values[:, label, :], index=self.periods, columns=self.issuers, copy=False)
+
+    def to_long(self, dropna=False):
+        """Long-format DataFrame in the master_table layout."""
+        n_periods, n_labels, n_issuers = self.values.shape
+        df = self.labels.iloc[np.tile(np.repeat(np.arange(n_labels), n_issuers), n_periods)].reset_index(drop=True)
+        df.insert(0, '기준년월', np.repeat(self.periods.to_numpy(), n_labels * n_issuers))
+        df['구분'] = np.tile(self.issuers.to_numpy(), n_periods * n_labels)
+        df['value'] = self.values.reshape(-1)
+        if dropna:
+            df = df.dropna(subset=['value']).reset_index(drop=True)
+        return df
+
+    def sum(self, axis='label'):
+        """Sum over one axis ('period', 'label' or 'issuer'), ignoring NaN. Returns a DataFrame."""
+        if axis == 'label':
+            return pd.DataFrame(np.nansum(self.values, axis=1), index=self.periods, columns=self.issuers)
+        if axis == 'issuer':
+            return pd.DataFrame(np.nansum(self.values, axis=2), index=self.periods,
+                                columns=pd.MultiIndex.from_frame(self.labels))
+        if axis == 'period':
+            return pd.DataFrame(np.nansum(self.values, axis=0), index=pd.MultiIndex.from_frame(self.labels),
+                                columns=self.issuers)
+        raise ValueError(f"axis must be 'period', 'label' or 'issuer', not {axis!r}")
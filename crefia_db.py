@@ -0,0 +1,174 @@
+"""
+crefia_db.py
+Shared access to master.db: pooled read-only connections for the dashboard and
+other readers, tuned connections for the loader, and atomic swap-in of a rebuilt file.
+
+Readers
+    read_connection() hands out a connection from a process-wide pool, opened
+    read-only (mode=ro) with a larger page cache and memory-mapped I/O. When
+    master.db can't change under the process (the file is not writable, or
+    CREFIA_DB_IMMUTABLE=1, e.g. a database baked into the container image) the
+    connections are opened with immutable=1, which skips locking altogether.
+    If master.db is replaced by a new file, the pool notices the new inode and
+    reopens its connections.
+
+Writers
+    connect_for_ingest() switches the database to WAL journaling, so readers
+    keep reading the last committed state while an ingest transaction runs.
+    Full rebuilds go to a separate file that swap_in() atomically renames over
+    master.db once it is complete. Nobody reads that file before the swap, so
+    connect_for_build() turns journaling and fsync off while it is written.
+"""
+
+import os
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+from urllib.parse import quote
+
+db_filename = 'master.db'
+
+# Reader tuning: 32 MiB page cache per connection, up to 256 MiB memory-mapped
+READ_PRAGMAS = {
+    'cache_size': -32 * 1024,
+    'mmap_size': 256 * 2**20,
+    'temp_store': 'MEMORY',
+    'query_only': 'ON',
+}
+# Idle connections kept per database file
+POOL_SIZE = int(os.environ.get('CREFIA_DB_POOL_SIZE', 8))
+
+
+def is_immutable(path):
+    """True if readers may open path with immutable=1 (nothing writes it while the process runs)."""
+    setting = os.environ.get('CREFIA_DB_IMMUTABLE')
+    if setting is not None:
+        return setting == '1'
+    return not os.access(path, os.W_OK)
+
+
+def connect_read_only(path=db_filename, immutable=None):
+    """Open a tuned read-only connection usable from any thread (one thread at a time)."""
+    if immutable is None:
+        immutable = is_immutable(path)
+    uri = f"file:{quote(os.path.abspath(path))}?mode=ro{'&immutable=1' if immutable else ''}"
+    conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+    for pragma, value in READ_PRAGMAS.items():
+        conn.execute(f'PRAGMA {pragma} = {value}')
+    return conn
+
+
+class ConnectionPool:
+    """Pool of read-only connections to one database file, reopened when the file is replaced."""
+
+    def __init__(self, path, size=POOL_SIZE):
+        self.path = path
+        self.size = size
+        self._lock = threading.Lock()
+        self._idle = queue.LifoQueue()
+        self._identity = None
+
+    def _file_identity(self):
+        st = os.stat(self.path)
+        return st.st_dev, st.st_ino
+
+    def _drain(self):
+        while True:
+            try:
+                _, conn = self._idle.get_nowait()
+            except queue.Empty:
+                return
+            conn.close()
+
+    @contextmanager
+    def connection(self):
+        identity = self._file_identity()
+        with self._lock:
+            if identity != self._identity:
+                # master.db was swapped for a new file: drop connections to the old one
+                self._drain()
+                self._identity = identity
+        try:
+            conn_identity, conn = self._idle.get_nowait()
+        except queue.Empty:
+            conn_identity, conn = identity, connect_read_only(self.path)
+        if conn_identity != identity:
+            conn.close()
+            conn_identity, conn = identity, connect_read_only(self.path)
+
+        try:
+            yield conn
+        finally:
+            if conn.in_transaction:
+                conn.rollback()
+            if conn_identity == self._identity and self._idle.qsize() < self.size:
+                self._idle.put((conn_identity, conn))
+            else:
+                conn.close()
+
+    def close(self):
+        with self._lock:
+            self._drain()
+            self._identity = None
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(path=db_filename):
+    """The process-wide pool for path."""
+    key = os.path.abspath(path)
+    with _pools_lock:
+        if key not in _pools:
+            _pools[key] = ConnectionPool(key)
+        return _pools[key]
+
+
+@contextmanager
+def read_connection(path=db_filename):
+    """Borrow a pooled read-only connection: `with read_connection() as conn: ...`."""
+    with get_pool(path).connection() as conn:
+        yield conn
+
+
+def connect_for_ingest(path=db_filename):
+    """Writer connection: WAL journaling, relaxed fsync inside WAL, large cache, busy timeout."""
+    conn = sqlite3.connect(path, timeout=30)
+    conn.execute('PRAGMA journal_mode = WAL')
+    conn.execute('PRAGMA synchronous = NORMAL')
+    conn.execute(f'PRAGMA cache_size = {-64 * 1024}')
+    return conn
+
+
+def connect_for_build(path):
+    """Bulk-load connection for a scratch file: no journal, no fsync, exclusive lock, large cache."""
+    conn = sqlite3.connect(path)
+    conn.execute('PRAGMA journal_mode = OFF')
+    conn.execute('PRAGMA synchronous = OFF')
+    conn.execute('PRAGMA locking_mode = EXCLUSIVE')
+    conn.execute(f'PRAGMA cache_size = {-128 * 1024}')
+    conn.execute('PRAGMA temp_store = MEMORY')
+    return conn
+
+
+def checkpoint(conn):
+    """Fold the WAL back into the main file so master.db is complete on its own."""
+    conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+
+
+def swap_in(new_path, path=db_filename):
+    """
+    Atomically replace path with the fully built database new_path.
+
+    Readers holding the old file keep reading it until they return their
+    connection; new connections see the new file.
+    """
+    with open(new_path, 'rb') as f:
+        os.fsync(f.fileno())
+    for suffix in ('-wal', '-shm'):
+        if os.path.exists(path + suffix) and not os.path.exists(new_path + suffix):
+            # A stale WAL must not be applied to the new file
+            os.remove(path + suffix)
+    os.replace(new_path, path)
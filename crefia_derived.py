@@ -0,0 +1,110 @@
+"""
+crefia_derived.py
+Derived metrics, computed from the materialized summary tables once per ingest.
+
+Every input is a 기준년월 x issuer table in the summary_metric layout (market
+total in the 합계 column), and every metric is whole-table arithmetic, with no
+loop over months or issuers:
+  - <metric>_mom, <metric>_yoy  growth over 1 and 12 months, for every summary metric
+  - net_adds                    신규회원수 - 해지회원수
+  - churn_rate                  해지회원수 / 전체회원수
+  - activation_rate             이용회원수 / 전체회원수
+  - share_<대분류>              issuer / market total of the 대분류's headline metric
+
+refresh_derived() stores the results in summary_metric next to the base metrics,
+so they are read back with read_summary() / load_tables() like any other metric.
+"""
+
+from typing import NamedTuple
+
+import numpy as np
+import pandas as pd
+
+from crefia_metrics import (MARKET_TOTAL, SUMMARY_ISSUERS, SUMMARY_METRICS,
+                            read_summary, summary_table)
+
+
+class DerivedMetric(NamedTuple):
+    name: str
+    title: str
+
+
+# 대분류: summary metric whose 합계 column is the market
+SHARE_BASES = {
+    '회원수': 'total_members',
+    '국내이용금액': 'domestic_sales',
+    '해외이용금액': 'overseas_sales',
+    '금융자산': 'finance_assets',
+}
+
+DERIVED_METRICS = {
+    spec.name: spec for spec in [
+        *(DerivedMetric(f'{name}_mom', f'{base.title} 전월대비 증감률') for name, base in SUMMARY_METRICS.items()),
+        *(DerivedMetric(f'{name}_yoy', f'{base.title} 전년동월대비 증감률') for name, base in SUMMARY_METRICS.items()),
+        DerivedMetric('net_adds', '순증회원수'),
+        DerivedMetric('churn_rate', '해지율'),
+        DerivedMetric('activation_rate', '활동회원비율'),
+        *(DerivedMetric(f'share_{대분류}', f'{대분류} 점유율') for 대분류 in SHARE_BASES),
+    ]
+}
+
+
+def month_ordinals(periods):
+    """기준년월 (YYYYMM) values as consecutive integers (year * 12 + month)."""
+    periods = pd.Index(periods).astype(str)
+    return (periods.str[:4].astype(int) * 12 + periods.str[4:6].astype(int)).to_numpy()
+
+
+def ratio(numerator, denominator):
+    """Element-wise numerator / denominator, NaN where undefined (missing or zero denominator)."""
+    result = numerator / denominator
+    return result.mask(~np.isfinite(result))
+
+
+def growth(table, months):
+    """Growth rate over `months` months of a 기준년월-indexed table; NaN where that month is missing."""
+    if table.empty:
+        return table.astype(float)
+    ordinals = month_ordinals(table.index)
+    offset = ordinals - ordinals.min()
+
+    # Lay the rows on a gapless month axis so that shifting by n rows is shifting by n months
+    calendar = np.full((offset.max() + 1, table.shape[1]), np.nan)
+    calendar[offset] = table.to_numpy(dtype=float)
+    earlier = np.full_like(calendar, np.nan)
+    if months < len(calendar):
+        earlier[months:] = calendar[:len(calendar) - months]
+
+    previous = pd.DataFrame(earlier[offset], index=table.index, columns=table.columns)
+    return ratio(table, previous) - 1
+
+
+def compute_derived(tables):
+    """Derived metrics of the summary tables ({name: 기준년월 x issuer table}). Returns {name: table}."""
+    tables = {name: table.astype(float) for name, table in tables.items()}
+    derived = {}
+    for name, table in tables.items():
+        derived[f'{name}_mom'] = growth(table, 1)
+        derived[f'{name}_yoy'] = growth(table, 12)
+
+    derived['net_adds'] = tables['new_users'] - tables['cancel_users']
+    derived['churn_rate'] = ratio(tables['cancel_users'], tables['total_members'])
+    derived['activation_rate'] = ratio(tables['active_users'], tables['total_members'])
+    for 대분류, base in SHARE_BASES.items():
+        derived[f'share_{대분류}'] = ratio(tables[base], tables[base][[MARKET_TOTAL]].to_numpy())
+    return derived
+
+
+def refresh_derived(conn, issuers=SUMMARY_ISSUERS):
+    """Recompute every derived metric from summary_metric and store it, on the caller's transaction."""
+    tables = read_summary(conn, SUMMARY_METRICS.values(), issuers)
+    derived = compute_derived(tables)
+
+    conn.execute(f'DELETE FROM {summary_table} WHERE metric IN ({", ".join("?" * len(derived))})',
+                 list(derived))
+    placeholders = ', '.join('?' * (len(issuers) + 2))
+    for name, table in derived.items():
+        # NaN -> NULL
+        values = table[list(issuers)].astype(object).where(table.notna(), None)
+        conn.executemany(f'INSERT INTO {summary_table} VALUES ({placeholders})',
+                         [(name, period, *row) for period, *row in values.itertuples(name=None)])
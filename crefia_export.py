@@ -0,0 +1,148 @@
+"""
+crefia_export.py
+Pre-rendered dashboard charts and tables, written once per ingest.
+
+Between two ingests every visitor sees the same charts for the same period
+range, so they are rendered ahead of time:
+  export/manifest.json                          data version, files and period range of each artifact
+  export/v<version>/charts/<metric>.<range>.vl.json   Vega-Lite spec (data inlined), per PERIOD_RANGES
+  export/v<version>/tables/<metric>.csv|.json         기준년월 x issuer table, newest month first
+
+The dashboard serves a chart from the export when the selected range is one of
+PERIOD_RANGES and the manifest's data version is the one in master.db; any
+other range is rendered live. The files are plain Vega-Lite / CSV / JSON, so
+the directory can also be published as is on a static site (vega-embed).
+
+1_to_sqlite3.py refreshes the export after every load; to run it on its own:
+    python crefia_export.py [master.db] [export]
+"""
+
+import os
+import sys
+import json
+import shutil
+import time
+
+from crefia_charts import line_chart
+from crefia_db import connect_read_only, db_filename
+from crefia_metrics import SUMMARY_METRICS, load_tables, read_data_version
+from crefia_profile import profiled, span
+
+export_dir = 'export'
+manifest_name = 'manifest.json'
+
+# Range name: months up to the latest month (None for the whole history)
+PERIOD_RANGES = {
+    'all': None,
+    '10y': 120,
+    '5y': 60,
+    '3y': 36,
+    '1y': 12,
+}
+
+# Metrics charted by the dashboard
+EXPORT_METRICS = SUMMARY_METRICS
+
+
+def period_ranges(periods):
+    """{range name: (start, end)} of the sorted 기준년월 values, for the ranges shorter than the history."""
+    if not periods:
+        return {}
+    ranges = {}
+    for name, months in PERIOD_RANGES.items():
+        if months is None or months < len(periods):
+            ranges[name] = (periods[0] if months is None else periods[-months], periods[-1])
+    return ranges
+
+
+def dump_json(obj, path):
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(obj, f, ensure_ascii=False, separators=(',', ':'))
+
+
+def load_manifest(out_dir=export_dir):
+    """The export's manifest, or None if there is no export."""
+    try:
+        with open(os.path.join(out_dir, manifest_name), encoding='utf-8') as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def load_spec(manifest, path, out_dir=export_dir):
+    """Vega-Lite spec of a chart listed in the manifest."""
+    with open(os.path.join(out_dir, manifest['dir'], path), encoding='utf-8') as f:
+        return json.load(f)
+
+
+@profiled()
+def export_static(db_path=db_filename, out_dir=export_dir, specs=None, force=False):
+    """
+    Render every chart and table of the dashboard for db_path's current data version.
+
+    Skipped when the export is already at that version (unless force). Artifacts
+    are written to a new v<version> directory and published by replacing the
+    manifest, so a reader never sees a half-written export. Returns the manifest.
+    """
+    specs = list((specs or EXPORT_METRICS).values())
+    conn = connect_read_only(db_path, immutable=False)
+    try:
+        data_version = read_data_version(conn)
+        manifest = load_manifest(out_dir)
+        if not force and manifest and manifest['data_version'] == data_version:
+            return manifest
+        metrics, pivots = load_tables(conn, specs)
+    finally:
+        conn.close()
+
+    version_dir = f'v{data_version}'
+    build_dir = os.path.join(out_dir, version_dir + '.building')
+    shutil.rmtree(build_dir, ignore_errors=True)
+    os.makedirs(os.path.join(build_dir, 'charts'))
+    os.makedirs(os.path.join(build_dir, 'tables'))
+
+    manifest = {
+        'data_version': data_version,
+        'generated_at': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'dir': version_dir,
+        'charts': {},
+        'tables': {},
+    }
+    for spec in specs:
+        df = metrics[spec.name]
+        periods = sorted(df['기준년월'].unique())
+        charts = manifest['charts'][spec.name] = {}
+        for range_name, (start, end) in period_ranges(periods).items():
+            with span('export_chart'):
+                chart, resolution = line_chart(df[(df['기준년월'] >= start) & (df['기준년월'] <= end)],
+                                               spec.title, spec.rollup)
+                path = f'charts/{spec.name}.{range_name}.vl.json'
+                dump_json(chart.to_dict(), os.path.join(build_dir, path))
+            charts[range_name] = {'start': start, 'end': end, 'resolution': resolution, 'path': path}
+
+        with span('export_table', rows=len(pivots[spec.name])):
+            table = pivots[spec.name]
+            table.to_csv(os.path.join(build_dir, 'tables', f'{spec.name}.csv'), encoding='utf-8-sig')
+            table.to_json(os.path.join(build_dir, 'tables', f'{spec.name}.json'), orient='split', force_ascii=False)
+        manifest['tables'][spec.name] = {'csv': f'tables/{spec.name}.csv', 'json': f'tables/{spec.name}.json'}
+
+    # Publish: the version directory first, then the manifest pointing at it
+    final_dir = os.path.join(out_dir, version_dir)
+    shutil.rmtree(final_dir, ignore_errors=True)
+    os.replace(build_dir, final_dir)
+    manifest_path = os.path.join(out_dir, manifest_name)
+    dump_json(manifest, manifest_path + '.tmp')
+    os.replace(manifest_path + '.tmp', manifest_path)
+
+    # Older versions are no longer referenced
+    for entry in os.listdir(out_dir):
+        if entry.startswith('v') and entry != version_dir and os.path.isdir(os.path.join(out_dir, entry)):
+            shutil.rmtree(os.path.join(out_dir, entry), ignore_errors=True)
+    return manifest
+
+
+if __name__ == '__main__':
+    manifest = export_static(*sys.argv[1:3], force=True)
+    n_charts = sum(len(charts) for charts in manifest['charts'].values())
+    print(f"Exported {n_charts} chart(s) and {len(manifest['tables'])} table(s) "
+          f"for data version {manifest['data_version']}.")
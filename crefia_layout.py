@@ -0,0 +1,182 @@
+"""
+crefia_layout.py
+Schema fingerprints of the monthly .xls sheets, checked against the layout crefia_label.csv describes.
+
+crefia_label.csv names the sheet rows by position. crefia_layout.json records the
+sheet layout it was written for: the row-label block of the sheet (its first five
+columns, as normalized keys) in crefia_label.csv order, and the fingerprints of
+sheets known to match it.
+
+A sheet's fingerprint is a hash of its header row and its row-label block.
+  - known fingerprint: the rows map one to one, nothing else is checked;
+  - unknown fingerprint: every label row is looked up by its key in the sheet.
+    If each is found exactly once the sheet is converted through that row mapping
+    (rows added or moved by CREFIA are handled); otherwise it is rejected with
+    LayoutError before anything is written.
+
+Results are cached per .xls file, by size and modification time, in
+csv/layout_cache.json, so files seen before are not checked again.
+
+Record the layout of a sheet that matches crefia_label.csv row for row:
+    python crefia_layout.py data/카드이용실적_월별_YYYYMM.xls
+"""
+
+import os
+import sys
+import json
+import hashlib
+
+import xlrd
+
+layout_path = 'crefia_layout.json'
+cache_path = os.path.join('csv', 'layout_cache.json')
+crefia_label_path = 'crefia_label.csv'
+
+# The first five columns of a sheet hold the row labels, issuers follow
+FIRST_VALUE_COLUMN = 5
+HEADER_LABEL = '구분'
+
+
+class LayoutError(ValueError):
+    """The sheet's rows can't be matched to crefia_label.csv."""
+
+
+def file_sha256(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def normalize(cell):
+    """Label text without any whitespace (the sheets wrap and space labels inconsistently)."""
+    return ''.join(str(cell).split())
+
+
+def row_keys(sheet):
+    """
+    One key per data row: its five label cells, blanks filled from the rows above.
+
+    The label block is a merged-cell hierarchy: a row only spells out the levels
+    that change, so a cell is inherited from above only left of the first filled one.
+    """
+    keys, current = [], [''] * FIRST_VALUE_COLUMN
+    for row in range(1, sheet.nrows):
+        cells = [normalize(cell) for cell in sheet.row_values(row, 0, FIRST_VALUE_COLUMN)]
+        first = next((i for i, cell in enumerate(cells) if cell), FIRST_VALUE_COLUMN)
+        current = current[:first] + cells[first:]
+        keys.append('|'.join(current))
+    return keys
+
+
+def header_cells(sheet):
+    return [normalize(cell) for cell in sheet.row_values(0)]
+
+
+def fingerprint(header, keys):
+    return hashlib.sha256(('\t'.join(header) + '\n' + '\n'.join(keys)).encode('utf-8')).hexdigest()
+
+
+def load_reference(path=layout_path):
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def check_header(header, name):
+    if header[:FIRST_VALUE_COLUMN] != [HEADER_LABEL] + [''] * (FIRST_VALUE_COLUMN - 1):
+        raise LayoutError(f'{name}: unexpected header {header[:FIRST_VALUE_COLUMN]}')
+    issuers = header[FIRST_VALUE_COLUMN:]
+    if not issuers or '' in issuers or len(set(issuers)) != len(issuers):
+        raise LayoutError(f'{name}: issuer columns are blank or repeated: {issuers}')
+
+
+def resolve_layout(sheet, reference, name=''):
+    """
+    Match the sheet to the reference layout.
+
+    Returns (fingerprint, row_map): row_map is None when the rows map one to one,
+    otherwise the sheet's data row for each crefia_label.csv row.
+    """
+    header, keys = header_cells(sheet), row_keys(sheet)
+    digest = fingerprint(header, keys)
+    if digest in reference['fingerprints']:
+        return digest, None
+
+    check_header(header, name)
+    positions = {}
+    for position, key in enumerate(keys):
+        positions.setdefault(key, []).append(position)
+    missing = [key for key in reference['label_keys'] if len(positions.get(key, [])) != 1]
+    if missing:
+        raise LayoutError(f'{name}: {len(missing)} label row(s) missing or repeated, e.g. {missing[:3]}')
+
+    row_map = [positions[key][0] for key in reference['label_keys']]
+    if row_map == list(range(len(keys))):
+        return digest, None
+    return digest, row_map
+
+
+def load_cache(reference, path=cache_path):
+    """Per-file layout cache; emptied when the reference layout changes."""
+    try:
+        with open(path, encoding='utf-8') as f:
+            cache = json.load(f)
+    except (FileNotFoundError, ValueError):
+        cache = {}
+    if cache.get('label_sha256') != reference['label_sha256']:
+        cache = {'label_sha256': reference['label_sha256'], 'files': {}}
+    return cache
+
+
+def save_cache(cache, path=cache_path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(cache, f, ensure_ascii=False, indent=1)
+
+
+def cached_layout(cache, xls_path):
+    """(fingerprint, row_map) cached for an unchanged xls_path, else None."""
+    entry = cache['files'].get(os.path.basename(xls_path))
+    st = os.stat(xls_path)
+    if entry and entry['size'] == st.st_size and entry['mtime_ns'] == st.st_mtime_ns:
+        return entry['fingerprint'], entry['row_map']
+    return None
+
+
+def cache_layout(cache, xls_path, digest, row_map):
+    st = os.stat(xls_path)
+    cache['files'][os.path.basename(xls_path)] = {
+        'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'fingerprint': digest, 'row_map': row_map,
+    }
+
+
+def register(xls_path, path=layout_path):
+    """Record xls_path as matching crefia_label.csv row for row."""
+    book = xlrd.open_workbook(xls_path, on_demand=True)
+    try:
+        sheet = book.sheet_by_index(0)
+        header, keys = header_cells(sheet), row_keys(sheet)
+    finally:
+        book.release_resources()
+    check_header(header, xls_path)
+    n_labels = sum(1 for _ in open(crefia_label_path, encoding='utf-8-sig')) - 1
+    if len(keys) != n_labels or len(set(keys)) != len(keys):
+        raise LayoutError(f'{xls_path}: {len(keys)} distinct label rows, crefia_label.csv has {n_labels}')
+
+    label_sha256 = file_sha256(crefia_label_path)
+    try:
+        reference = load_reference(path)
+    except FileNotFoundError:
+        reference = {}
+    if reference.get('label_keys') != keys or reference.get('label_sha256') != label_sha256:
+        reference = {'label_sha256': label_sha256, 'label_keys': keys, 'fingerprints': []}
+    digest = fingerprint(header, keys)
+    if digest not in reference['fingerprints']:
+        reference['fingerprints'].append(digest)
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(reference, f, ensure_ascii=False, indent=1)
+        f.write('\n')
+    return digest
+
+
+if __name__ == '__main__':
+    for xls_path in sys.argv[1:]:
+        print(f'{xls_path}: {register(xls_path)}')
@@ -0,0 +1,248 @@
+"""
+crefia_metrics.py
+Metric specs for the dashboard and a query layer that fetches many metrics in one pass.
+
+A metric is one label row of crefia_label.csv, identified by its
+(신용체크구분, 개인법인구분, 대분류, 중분류, 소분류) values. Leaving 신용체크구분 as None
+sums the metric over credit and check cards, and likewise for the other columns. fetch_metrics() loads every requested
+metric with a single query on one connection and splits the result in memory.
+
+The loader also materializes every summary metric into summary_metric, one row
+per (metric, 기준년월) with a column per issuer and one for the market total (합계),
+so the dashboard can read the pivoted tables directly with read_summary().
+"""
+
+import sqlite3
+from typing import NamedTuple, Optional
+
+import pandas as pd
+
+from crefia_profile import profiled, span
+
+table_name = 'master_table'
+version_table = 'data_version'
+summary_table = 'summary_metric'
+
+# Issuers shown on the dashboard
+ISSUERS = ('롯데카드', '삼성카드', '신한카드', '우리카드',
+           '하나카드', '현대카드', 'KB국민카드')
+
+# Market total, materialized alongside the issuers (the denominator of market shares).
+# The sheets publish it for amounts only; it is the sum of the issuers except 비씨카드 기타,
+# which is how it is derived where the sheet leaves it blank (회원수).
+MARKET_TOTAL = '합계'
+NOT_IN_MARKET_TOTAL = (MARKET_TOTAL, '비씨카드 기타')
+SUMMARY_ISSUERS = ISSUERS + (MARKET_TOTAL,)
+
+FILTER_COLUMNS = ('신용체크구분', '개인법인구분', '대분류', '중분류', '소분류')
+
+
+class MetricSpec(NamedTuple):
+    name: str
+    title: str
+    신용체크구분: Optional[str]
+    대분류: str
+    중분류: Optional[str]
+    소분류: Optional[str]
+    개인법인구분: Optional[str] = '개인'
+    # How long chart ranges are reduced (see crefia_resample.py): 'last' for counts at
+    # month end, 'mean' for flows within the month, 'lttb' to thin the monthly line
+    rollup: str = 'last'
+
+    def filters(self):
+        """(column, value) pairs that select this metric's rows; None means any value."""
+        return [(col, getattr(self, col)) for col in FILTER_COLUMNS if getattr(self, col) is not None]
+
+
+# Metrics shown on the dashboard
+MEMBER_METRICS = {
+    spec.name: spec for spec in [
+        MetricSpec('total_members', '전체회원수', None, '회원수', '전체회원수', '합계'),
+        MetricSpec('crd_mbrs', '전체신용회원수', '신용카드', '회원수', '전체회원수', '본인기준회원수'),
+        MetricSpec('cnf_mbrs', '전체체크회원수', '직불/체크카드', '회원수', '사용가능회원수', '사용가능회원수'),
+        MetricSpec('active_users', '이용회원수', '신용카드', '회원수', '전체이용회원수', '합계', rollup='lttb'),
+        MetricSpec('new_users', '신규회원수', '신용카드', '회원수', '신규회원수(월중)', '본인기준회원수', rollup='mean'),
+        MetricSpec('cancel_users', '해지회원수', '신용카드', '회원수', '해지회원수(월중)', '해지회원수(월중)', rollup='mean'),
+    ]
+}
+
+# Headline total of each 대분류 other than 회원수 (bases of market shares, see crefia_derived.py)
+MARKET_METRICS = {
+    spec.name: spec for spec in [
+        MetricSpec('domestic_sales', '국내이용금액', None, '국내이용금액', None, None, None, rollup='mean'),
+        MetricSpec('overseas_sales', '해외이용금액', None, '해외이용금액', None, None, None, rollup='mean'),
+        MetricSpec('finance_assets', '금융자산', '금융자산', '금융자산', '합계', '합계', '금융자산'),
+    ]
+}
+
+# Everything materialized in summary_metric by 1_to_sqlite3.py
+SUMMARY_METRICS = {**MEMBER_METRICS, **MARKET_METRICS}
+
+
+def read_data_version(conn):
+    """Return the data version stamp written by 1_to_sqlite3.py (0 if never stamped)."""
+    try:
+        row = conn.execute(f'SELECT version FROM {version_table}').fetchone()
+    except sqlite3.OperationalError:
+        # Database built before the version table existed
+        return 0
+    return row[0] if row else 0
+
+
+def build_query(specs, issuers=ISSUERS):
+    """Return (sql, params) selecting the rows of every spec in one statement."""
+    conditions, params = [], []
+    for spec in specs:
+        filters = spec.filters()
+        conditions.append('(' + ' AND '.join(f'{col} = ?' for col, _ in filters) + ')')
+        params.extend(value for _, value in filters)
+    params.extend(issuers)
+
+    sql = f'''
+        SELECT {', '.join(FILTER_COLUMNS)}, 기준년월, 구분, value
+          FROM {table_name}
+         WHERE ({' OR '.join(conditions)})
+           AND 구분 IN ({', '.join('?' * len(issuers))})
+        '''
+    return sql, params
+
+
+def split_metrics(df, specs):
+    """Split the combined rows into one (기준년월, 구분, value) frame per spec name."""
+    frames = {}
+    for spec in specs:
+        mask = pd.Series(True, index=df.index)
+        for col, value in spec.filters():
+            mask &= df[col] == value
+        df_metric = df.loc[mask, ['기준년월', '구분', 'value']]
+        if any(getattr(spec, col) is None for col in FILTER_COLUMNS):
+            # Sum over the open columns (e.g. credit + check members)
+            df_metric = df_metric.groupby(['기준년월', '구분'], as_index=False)['value'].sum()
+        frames[spec.name] = df_metric.sort_values(['기준년월', '구분']).reset_index(drop=True)
+    return frames
+
+
+def fetch_metrics(conn, specs, issuers=ISSUERS):
+    """Fetch every spec with one query on conn. Returns {spec.name: DataFrame}."""
+    specs = list(specs)
+    sql, params = build_query(specs, issuers)
+    with span('read_sql_query') as s:
+        df = pd.read_sql_query(sql, conn, params=params)
+        s.rows = len(df)
+    with span('split_metrics', rows=len(df)):
+        return split_metrics(df, specs)
+
+
+def create_summary_table(conn, issuers=SUMMARY_ISSUERS):
+    """Create summary_metric, recreating it if its issuer columns changed. Returns True if created."""
+    columns = [row[1] for row in conn.execute(f'PRAGMA table_info({summary_table})')]
+    if columns == ['metric', '기준년월', *issuers]:
+        return False
+    conn.execute(f'DROP TABLE IF EXISTS {summary_table}')
+    issuer_columns = ''.join(f',\n            "{issuer}" REAL' for issuer in issuers)
+    conn.execute(f'''
+        CREATE TABLE {summary_table} (
+            metric  TEXT NOT NULL,
+            기준년월 TEXT NOT NULL{issuer_columns},
+            PRIMARY KEY (metric, 기준년월)
+        ) WITHOUT ROWID''')
+    return True
+
+
+def refresh_summary(conn, specs, periods=None, issuers=SUMMARY_ISSUERS):
+    """Rebuild the summary rows of `periods` (all periods if None) on the caller's transaction."""
+    period_filter, period_params = '', []
+    if periods is not None:
+        periods = [str(p) for p in periods]
+        period_filter = f'AND 기준년월 IN ({", ".join("?" * len(periods))})'
+        period_params = periods
+        conn.execute(f'DELETE FROM {summary_table} WHERE 기준년월 IN ({", ".join("?" * len(periods))})',
+                     periods)
+    else:
+        conn.execute(f'DELETE FROM {summary_table}')
+
+    # One row per month, one column per issuer
+    columns, column_params = [], []
+    for issuer in issuers:
+        if issuer == MARKET_TOTAL:
+            columns.append(f'''COALESCE(SUM(CASE WHEN 구분 = ? THEN value END),
+                     SUM(CASE WHEN 구분 NOT IN ({', '.join('?' * len(NOT_IN_MARKET_TOTAL))}) THEN value END))''')
+            column_params.extend([MARKET_TOTAL, *NOT_IN_MARKET_TOTAL])
+        else:
+            columns.append('SUM(CASE WHEN 구분 = ? THEN value END)')
+            column_params.append(issuer)
+    # The market total needs every issuer's rows
+    issuer_filter, issuer_params = '', []
+    if MARKET_TOTAL not in issuers:
+        issuer_filter = f'AND 구분 IN ({", ".join("?" * len(issuers))})'
+        issuer_params = list(issuers)
+
+    for spec in specs:
+        filters = spec.filters()
+        conn.execute(f'''
+            INSERT INTO {summary_table}
+            SELECT ?, 기준년월, {', '.join(columns)}
+              FROM {table_name}
+             WHERE {' AND '.join(f'{col} = ?' for col, _ in filters)}
+               {issuer_filter}
+               {period_filter}
+             GROUP BY 기준년월''',
+            [spec.name, *column_params, *(value for _, value in filters), *issuer_params, *period_params])
+
+
+def read_summary(conn, specs, issuers=ISSUERS):
+    """Read materialized metrics. Returns {spec.name: DataFrame indexed by 기준년월, one column per issuer}."""
+    specs = list(specs)
+    with span('read_sql_query') as s:
+        df = pd.read_sql_query(
+            f'''SELECT * FROM {summary_table}
+                 WHERE metric IN ({', '.join('?' * len(specs))})
+                 ORDER BY metric, 기준년월''',
+            conn, params=[spec.name for spec in specs])
+        s.rows = len(df)
+    frames = {}
+    for spec in specs:
+        df_metric = df[df['metric'] == spec.name].set_index('기준년월')[list(issuers)]
+        df_metric.columns.name = '구분'
+        frames[spec.name] = df_metric
+    return frames
+
+
+def read_periods(conn):
+    """Every 기준년월 with data, sorted. Reads summary_metric, or master_table when master.db predates it."""
+    try:
+        df = pd.read_sql_query(f'SELECT DISTINCT 기준년월 FROM {summary_table} ORDER BY 기준년월', conn)
+    except pd.errors.DatabaseError:
+        df = pd.read_sql_query(f'SELECT DISTINCT 기준년월 FROM {table_name} ORDER BY 기준년월', conn)
+    return df['기준년월'].astype(str).tolist()
+
+
+@profiled()
+def load_tables(conn, specs):
+    """
+    Long frames and pivoted tables for specs, as the dashboard uses them.
+
+    Returns ({name: (기준년월, 구분, value) frame}, {name: 기준년월 x issuer table, newest month first}).
+    Reads summary_metric, or pivots the batched query when master.db predates it.
+    """
+    specs = list(specs)
+    try:
+        # Materialized by 1_to_sqlite3.py, already one column per issuer
+        with span('read_summary'):
+            tables = read_summary(conn, specs)
+    except pd.errors.DatabaseError:
+        frames = fetch_metrics(conn, specs)
+        with span('pivot'):
+            tables = {
+                name: df.pivot(index='기준년월', columns='구분', values='value')
+                for name, df in frames.items()
+            }
+    with span('melt'):
+        metrics = {
+            name: table.reset_index()
+                       .melt(id_vars='기준년월', var_name='구분', value_name='value')
+                       .dropna(subset=['value'])
+            for name, table in tables.items()
+        }
+    pivots = {name: table.sort_index(ascending=False) for name, table in tables.items()}
+    return metrics, pivots
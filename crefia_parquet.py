@@ -0,0 +1,65 @@
+"""
+crefia_parquet.py
+Columnar copy of the master data as a Parquet dataset, partitioned by 기준년월.
+
+1_to_sqlite3.py writes the months it loads with write_months(); analysis scripts
+read with load_data(), which only touches the requested columns and, through
+predicate pushdown, only the partitions and row groups matching the filters.
+Dimension columns are dictionary-encoded and come back as pandas categoricals.
+"""
+
+import os
+
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+parquet_dir = 'parquet'
+
+DIMENSION_COLUMNS = ['신용체크구분', '개인법인구분', '대분류', '중분류', '소분류', '구분']
+
+PARTITIONING = ds.partitioning(pa.schema([('기준년월', pa.string())]), flavor='hive')
+
+
+def write_months(df, root=parquet_dir):
+    """Write the months in df, replacing those partitions and leaving the others untouched."""
+    df = df.astype({col: 'category' for col in DIMENSION_COLUMNS})
+    df['기준년월'] = df['기준년월'].astype(str)
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    ds.write_dataset(
+        table, root,
+        format='parquet',
+        partitioning=PARTITIONING,
+        basename_template='part-{i}.parquet',
+        existing_data_behavior='delete_matching',
+    )
+
+
+def partition_exists(period, root=parquet_dir):
+    """True if the dataset has a partition for 기준년월 period."""
+    return os.path.isdir(os.path.join(root, f'기준년월={period}'))
+
+
+def dataset_exists(root=parquet_dir):
+    """True if the dataset directory exists and is not empty."""
+    return os.path.isdir(root) and any(os.scandir(root))
+
+
+def load_data(columns=None, filters=None, root=parquet_dir):
+    """
+    Load the dataset into a DataFrame.
+
+    columns: columns to read (default: all).
+    filters: predicates in the pandas/pyarrow read_parquet format, e.g.
+             [('대분류', '==', '회원수'), ('기준년월', '>=', '202401')].
+             Filters on 기준년월 prune whole partitions.
+    """
+    if not dataset_exists(root):
+        raise FileNotFoundError(f"Parquet dataset '{root}' not found, run 1_to_sqlite3.py first.")
+    dataset = ds.dataset(root, format='parquet', partitioning=PARTITIONING)
+    expression = pq.filters_to_expression(filters) if filters else None
+    df = dataset.to_table(columns=columns, filter=expression).to_pandas()
+    # The partition column is appended last by pyarrow, put it back in front
+    if '기준년월' in df.columns:
+        df = df[['기준년월', *df.columns.drop('기준년월')]]
+    return df
@@ -0,0 +1,74 @@
+"""
+crefia_period.py
+Period index shared by the dashboard sections.
+
+기준년월 ('YYYYMM') is converted once, when a section's data is loaded, to an
+integer month ordinal (year * 12 + month, as in crefia_derived.month_ordinals),
+and every frame is sorted by it. A period range is then two binary searches
+(np.searchsorted) and a positional slice, instead of string comparisons over
+the whole frame on every rerun.
+"""
+
+import numpy as np
+
+from crefia_derived import month_ordinals
+from crefia_metrics import load_tables
+from crefia_profile import span
+
+
+def to_ordinal(period):
+    """'YYYYMM' as a month ordinal. Raises ValueError for anything else."""
+    period = str(period)
+    if len(period) != 6 or not period.isdigit() or not 1 <= int(period[4:]) <= 12:
+        raise ValueError(f'not a YYYYMM month: {period!r}')
+    return int(period[:4]) * 12 + int(period[4:])
+
+
+def to_period(ordinal):
+    """Month ordinal as 'YYYYMM'."""
+    year, month = divmod(int(ordinal) - 1, 12)
+    return f'{year:04d}{month + 1:02d}'
+
+
+class PeriodFrame:
+    """
+    A frame sorted by month, with the month ordinal of each row.
+
+    The months are the 기준년월 column, or the index for a 기준년월-indexed table.
+    """
+    __slots__ = ('frame', 'ordinals')
+
+    def __init__(self, frame):
+        periods = frame['기준년월'] if '기준년월' in frame.columns else frame.index
+        ordinals = month_ordinals(periods)
+        order = np.argsort(ordinals, kind='stable')
+        self.frame = frame.iloc[order]
+        self.ordinals = ordinals[order]
+
+    def __len__(self):
+        return len(self.ordinals)
+
+    def slice(self, start=None, end=None):
+        """Rows from month ordinal start to end, inclusive (None: unbounded)."""
+        lo = 0 if start is None else int(np.searchsorted(self.ordinals, start, side='left'))
+        hi = len(self.ordinals) if end is None else int(np.searchsorted(self.ordinals, end, side='right'))
+        return self.frame.iloc[lo:hi]
+
+    def bounds(self, start=None, end=None):
+        """(first, last) month ordinal with rows in the range, or None if it is empty."""
+        lo = 0 if start is None else int(np.searchsorted(self.ordinals, start, side='left'))
+        hi = len(self.ordinals) if end is None else int(np.searchsorted(self.ordinals, end, side='right'))
+        return (int(self.ordinals[lo]), int(self.ordinals[hi - 1])) if hi > lo else None
+
+
+def load_indexed(conn, specs):
+    """
+    load_tables() with every frame indexed by month.
+
+    Returns ({name: PeriodFrame of the (기준년월, 구분, value) frame},
+             {name: PeriodFrame of the 기준년월 x issuer table, oldest month first}).
+    """
+    metrics, pivots = load_tables(conn, specs)
+    with span('index_periods'):
+        return ({name: PeriodFrame(df) for name, df in metrics.items()},
+                {name: PeriodFrame(table) for name, table in pivots.items()})
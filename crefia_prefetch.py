@@ -0,0 +1,66 @@
+"""
+crefia_prefetch.py
+Runs read-only SQLite queries concurrently on a small shared thread pool.
+
+Each job borrows a read-only connection from the crefia_db pool, so queries
+started together overlap instead of running one after another.
+"""
+
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from crefia_db import read_connection
+
+# Worker threads shared by every caller in the process
+MAX_WORKERS = int(os.environ.get('CREFIA_QUERY_THREADS', 4))
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    """The process-wide query thread pool, created on first use."""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix='crefia-query')
+        return _executor
+
+
+def _run(db_filename, fn, args):
+    with read_connection(db_filename) as conn:
+        return fn(conn, *args)
+
+
+def submit(db_filename, fn, *args):
+    """Run fn(conn, *args) on the pool with a read-only connection. Returns a Future."""
+    return get_executor().submit(_run, db_filename, fn, args)
+
+
+def prefetch(db_filename, jobs):
+    """Start every job at once. jobs: {name: (fn, args)}. Returns {name: Future}."""
+    return {name: submit(db_filename, fn, *args) for name, (fn, args) in jobs.items()}
+
+
+_shared = {}
+
+
+def prefetch_shared(db_filename, key, jobs):
+    """
+    prefetch(), started once per database and key (e.g. its data version) for the whole process.
+
+    Every caller with the same key gets the same futures, so jobs started by the
+    startup warm-up (crefia_serve.py) are picked up by the first page view.
+    Only the latest key is kept per database; failed jobs are started again.
+    """
+    with _executor_lock:
+        entry = _shared.get(db_filename)
+        if entry is not None and entry[0] == key:
+            futures = entry[1]
+            if not any(f.done() and f.exception() is not None for f in futures.values()):
+                return futures
+    futures = prefetch(db_filename, jobs)
+    with _executor_lock:
+        _shared[db_filename] = (key, futures)
+    return futures
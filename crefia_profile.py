@@ -0,0 +1,175 @@
+"""
+crefia_profile.py
+Lightweight timing spans for the pipeline scripts and the dashboard.
+
+Off unless CREFIA_PROFILE=1 is set, and then cheap enough to leave on:
+
+    with span('read_csv') as s:
+        df = pd.read_csv(path)
+        s.rows = len(df)
+
+Each span records its wall time, the rows it processed (if given) and the change
+in the process's resident memory. Spans nest per thread ('ingest/insert_rows').
+
+Batch scripts call start_report('load') once; the aggregated spans are written to
+profile/load.json (CREFIA_PROFILE_DIR to change the directory) when the script
+exits. The dashboard shows the spans of each rerun in a sidebar panel.
+"""
+
+import os
+import sys
+import json
+import time
+import atexit
+import functools
+import threading
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:
+    # Windows
+    resource = None
+
+ENABLED = os.environ.get('CREFIA_PROFILE', '') not in ('', '0')
+report_dir = os.environ.get('CREFIA_PROFILE_DIR', 'profile')
+
+_records = []
+_lock = threading.Lock()
+_local = threading.local()
+_started = time.perf_counter()
+
+
+class Span:
+    """Handle yielded by span(); set .rows once the row count is known."""
+    __slots__ = ('rows',)
+
+    def __init__(self, rows=None):
+        self.rows = rows
+
+
+def rss_bytes():
+    """Current resident set size (peak RSS where /proc is unavailable)."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        if resource is None:
+            return 0
+        # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+
+
+@contextmanager
+def span(name, rows=None):
+    """Time the block as `name`. A no-op unless profiling is enabled."""
+    handle = Span(rows)
+    if not ENABLED:
+        yield handle
+        return
+
+    stack = _local.__dict__.setdefault('stack', [])
+    stack.append(name)
+    path = '/'.join(stack)
+    rss, start = rss_bytes(), time.perf_counter()
+    try:
+        yield handle
+    finally:
+        wall = time.perf_counter() - start
+        stack.pop()
+        record = {
+            'span': path,
+            'wall_s': wall,
+            'rows': handle.rows,
+            'rss_delta_mb': (rss_bytes() - rss) / 2**20,
+            'start_s': start - _started,
+            'thread': threading.current_thread().name,
+        }
+        with _lock:
+            _records.append(record)
+
+
+def profiled(name=None):
+    """Decorator: run the function inside span(name or the function's name)."""
+    def decorator(fn):
+        label = name or fn.__name__
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not ENABLED:
+                return fn(*args, **kwargs)
+            with span(label):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def mark():
+    """Position in the record list, for records(since=mark())."""
+    with _lock:
+        return len(_records)
+
+
+def records(since=0):
+    with _lock:
+        return _records[since:]
+
+
+def merge(more):
+    """Add records collected in another process."""
+    with _lock:
+        _records.extend(more)
+
+
+def call_collecting(fn, *args):
+    """Process pool job: run fn(*args) and return (result, the records of its spans)."""
+    start = mark()
+    result = fn(*args)
+    with _lock:
+        taken = _records[start:]
+        del _records[start:]
+    return result, taken
+
+
+def summary(recs):
+    """Aggregate records per span name, in order of first appearance."""
+    spans = {}
+    for r in recs:
+        s = spans.setdefault(r['span'], {'span': r['span'], 'calls': 0, 'wall_s': 0.0, 'max_s': 0.0,
+                                         'rows': None, 'rss_delta_mb': 0.0})
+        s['calls'] += 1
+        s['wall_s'] += r['wall_s']
+        s['max_s'] = max(s['max_s'], r['wall_s'])
+        s['rss_delta_mb'] += r['rss_delta_mb']
+        if r['rows'] is not None:
+            s['rows'] = (s['rows'] or 0) + r['rows']
+    for s in spans.values():
+        s['rows_per_s'] = round(s['rows'] / s['wall_s'], 1) if s['rows'] and s['wall_s'] else None
+        for key in ('wall_s', 'max_s'):
+            s[key] = round(s[key], 6)
+        s['rss_delta_mb'] = round(s['rss_delta_mb'], 2)
+    return list(spans.values())
+
+
+def write_report(stage, path=None):
+    """Write the aggregated spans of this process to profile/<stage>.json. Returns the path."""
+    path = path or os.path.join(report_dir, f'{stage}.json')
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    report = {
+        'stage': stage,
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'argv': sys.argv,
+        'total_wall_s': round(time.perf_counter() - _started, 6),
+        'rss_mb': round(rss_bytes() / 2**20, 1),
+        'spans': summary(records()),
+    }
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+        f.write('\n')
+    return path
+
+
+def start_report(stage):
+    """Batch scripts: write the report of this run when the process exits (if profiling is enabled)."""
+    if ENABLED:
+        atexit.register(write_report, stage)
@@ -0,0 +1,90 @@
+"""
+crefia_resample.py
+Keeps time-series charts to a bounded number of points, however long the history.
+
+A chart of a period range gets at most MAX_POINTS points per issuer:
+  - ranges of up to MAX_POINTS months are drawn month by month;
+  - longer ranges are rolled up to quarters, or to years if there are still too
+    many quarters, using the metric's rollup: 'last' (the count at the end of the
+    quarter/year), 'mean' (average month of a flow) or 'sum';
+  - rollup='lttb' keeps monthly resolution and thins each issuer's line with
+    Largest-Triangle-Three-Buckets, which keeps its peaks and troughs.
+
+Chart frames carry a datetime 기준일 column (first day of the month, quarter or
+year) for a temporal x axis, instead of the 기준년월 text.
+"""
+
+import numpy as np
+import pandas as pd
+
+# Points per issuer sent to the browser
+MAX_POINTS = 120
+
+# Resolution: (pandas period frequency, axis label format)
+RESOLUTIONS = {
+    'month': ('M', '%Y-%m'),
+    'quarter': ('Q', '%Y Q%q'),
+    'year': ('Y', '%Y'),
+}
+
+
+def month_starts(periods):
+    """기준년월 (YYYYMM) values as datetime64 month starts."""
+    return pd.to_datetime(pd.Series(periods).astype(str), format='%Y%m')
+
+
+def lttb(x, y, n_out):
+    """Positions of the n_out points of (x, y) kept by Largest-Triangle-Three-Buckets."""
+    n = len(x)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+
+    # First and last points are always kept; the rest is split into n_out - 2 buckets
+    edges = np.linspace(1, n - 1, n_out - 1).astype(int)
+    keep = np.empty(n_out, dtype=int)
+    keep[0], keep[-1] = 0, n - 1
+    a = 0
+    for i in range(n_out - 2):
+        lo, hi = edges[i], edges[i + 1]
+        # Average point of the next bucket (the last point, for the last bucket)
+        next_hi = edges[i + 2] if i + 2 < len(edges) else n
+        avg_x, avg_y = x[hi:next_hi].mean(), y[hi:next_hi].mean()
+        # Keep the point making the largest triangle with the last kept point and that average
+        area = np.abs((x[a] - avg_x) * (y[lo:hi] - y[a]) - (x[a] - x[lo:hi]) * (avg_y - y[a]))
+        a = lo + int(np.argmax(area))
+        keep[i + 1] = a
+    return keep
+
+
+def resample(df, rollup='last', max_points=MAX_POINTS):
+    """
+    Chart frame of a (기준년월, 구분, value) frame, at most max_points points per issuer.
+
+    Returns (frame with 기준일, 구분, value columns, resolution name).
+    """
+    df = df.sort_values(['구분', '기준년월'], kind='stable')
+    dates = month_starts(df['기준년월'].to_numpy())
+    dates.index = df.index
+    chart = pd.DataFrame({'기준일': dates, '구분': df['구분'].astype('category'), 'value': df['value']})
+
+    if dates.nunique() <= max_points:
+        return chart.reset_index(drop=True), 'month'
+
+    if rollup == 'lttb':
+        ordinals = (dates.dt.year * 12 + dates.dt.month).to_numpy(dtype=float)
+        values = chart['value'].to_numpy(dtype=float)
+        keep = []
+        for positions in chart.groupby('구분', observed=True).indices.values():
+            keep.append(positions[lttb(ordinals[positions], values[positions], max_points)])
+        return chart.iloc[np.concatenate(keep)].reset_index(drop=True), 'month'
+
+    for resolution in ('quarter', 'year'):
+        buckets = dates.dt.to_period(RESOLUTIONS[resolution][0]).dt.start_time
+        if buckets.nunique() <= max_points:
+            break
+    # Rows are in month order within each issuer, so 'last' is the latest month of the bucket
+    chart = (chart.assign(기준일=buckets)
+                  .groupby(['구분', '기준일'], observed=True)['value']
+                  .agg(rollup)
+                  .reset_index()[['기준일', '구분', 'value']])
+    return chart, resolution
@@ -0,0 +1,34 @@
+"""
+crefia_sections.py
+Sections of the dashboard page and the queries behind them.
+
+Shared by the page (4_visualize_data.py, which holds the renderers) and its
+launcher (crefia_serve.py, which starts the same queries before the first
+visitor arrives), so both key crefia_prefetch on the same jobs.
+"""
+
+# Page sections in display order: the metrics each one renders
+SECTION_METRICS = {
+    'sales': ['domestic_sales', 'overseas_sales'],
+    'members': ['crd_mbrs', 'cnf_mbrs'],
+    'active_users': ['active_users'],
+    'new_users': ['new_users'],
+    'cancel_users': ['cancel_users'],
+    'finance': ['finance_assets'],
+}
+
+# Job of the months with data, for the page's period control
+PERIODS_JOB = 'periods'
+
+
+def page_jobs():
+    """The page's queries for crefia_prefetch: the period axis, and one month-indexed load per section."""
+    # Imported here so the launcher can import this module before pandas is loaded
+    from crefia_metrics import SUMMARY_METRICS, read_periods
+    from crefia_period import load_indexed
+    jobs = {PERIODS_JOB: (read_periods, ())}
+    jobs.update({
+        name: (load_indexed, ([SUMMARY_METRICS[metric] for metric in metric_names],))
+        for name, metric_names in SECTION_METRICS.items()
+    })
+    return jobs
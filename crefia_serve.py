@@ -0,0 +1,53 @@
+"""
+crefia_serve.py
+Dashboard entry point with a warm start: `streamlit run 4_visualize_data.py`, after warming up.
+
+A Streamlit server only runs the page script when the first visitor connects,
+so after a scale-to-zero cold start that visitor pays for every import and
+query. This launcher starts the server and, in a background thread at the same
+time, imports the page's modules, opens the read-only connection pool and
+starts the dashboard queries of the current data version
+(crefia_prefetch.prefetch_shared), which the first page view then picks up.
+
+    python crefia_serve.py [streamlit run options, e.g. --server.port 8501]
+"""
+
+import sys
+import threading
+
+from crefia_profile import profiled
+from crefia_sections import page_jobs
+
+app_script = '4_visualize_data.py'
+db_filename = 'master.db'
+
+
+@profiled()
+def warm_up(db_path=db_filename):
+    """Import the page's modules, open the connection pool and start the page's queries. Returns their futures."""
+    import pandas  # noqa: F401
+    from crefia_db import read_connection
+    from crefia_export import load_manifest
+    from crefia_metrics import read_data_version
+    from crefia_prefetch import prefetch_shared
+
+    with read_connection(db_path) as conn:
+        data_version = read_data_version(conn)
+    futures = prefetch_shared(db_path, data_version, page_jobs())
+    manifest = load_manifest()
+    if manifest is None or manifest['data_version'] != data_version:
+        # Charts will be rendered live
+        import crefia_charts  # noqa: F401
+        import altair  # noqa: F401
+    return futures
+
+
+def main(argv=None):
+    threading.Thread(target=warm_up, name='crefia-warm-up', daemon=True).start()
+    from streamlit.web import cli as stcli
+    sys.argv = ['streamlit', 'run', app_script, *(sys.argv[1:] if argv is None else argv)]
+    return stcli.main()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
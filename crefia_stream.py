@@ -0,0 +1,197 @@
+"""
+crefia_stream.py
+Out-of-core reads of master.db, for analysis over the full history in bounded memory.
+
+Filters are pushed into SQL: label and issuer criteria become id lists of
+dim_metric / dim_issuer (so fact_value is read through its primary key) and
+periods are range conditions. The matching fact_value rows stream through
+pd.read_sql_query(chunksize=...) as four numeric columns, and every chunk is
+folded into the result before the next one is read:
+  - load_cube()    scatters the chunks into a crefia_cube.Cube, the only thing kept
+  - groupby_agg()  combines per-chunk sum / count / min / max partials per group
+  - iter_long()    yields master_table-layout frames, one chunk at a time
+
+MEMORY_BUDGET_MB (CREFIA_MEMORY_BUDGET_MB, default 256) sets the chunk size and
+caps the size of a cube; a cube that would not fit raises MemoryError before
+anything is read. 2_data_preprocessing.py and 3_data_analysis.py read through
+this module instead of the Parquet dataset when CREFIA_OUT_OF_CORE=1.
+"""
+
+import os
+
+import numpy as np
+import pandas as pd
+
+from crefia_cube import LABEL_COLUMNS, Cube
+from crefia_profile import span
+
+OUT_OF_CORE = os.environ.get('CREFIA_OUT_OF_CORE', '') not in ('', '0')
+MEMORY_BUDGET_MB = int(os.environ.get('CREFIA_MEMORY_BUDGET_MB', 256))
+# Share of the budget for the chunk being read; the rest is for the result
+CHUNK_SHARE = 0.25
+# Peak bytes per fact row while a chunk is fetched (row tuples) and framed, measured
+ROW_BYTES = 500
+
+AGGREGATIONS = ('sum', 'count', 'mean', 'min', 'max')
+
+
+def chunk_rows(budget_mb=MEMORY_BUDGET_MB):
+    """Rows per chunk that keep one chunk within its share of the budget."""
+    return max(1000, int(budget_mb * 2**20 * CHUNK_SHARE / ROW_BYTES))
+
+
+def as_list(value):
+    if value is None:
+        return None
+    return [value] if isinstance(value, (str, int)) else list(value)
+
+
+def read_dimensions(conn):
+    """dim_metric (LABEL_COLUMNS) and dim_issuer (구분) frames, indexed by id."""
+    metrics = pd.read_sql_query(f'SELECT metric_id, {", ".join(LABEL_COLUMNS)} FROM dim_metric ORDER BY metric_id',
+                                conn, index_col='metric_id')
+    issuers = pd.read_sql_query('SELECT issuer_id, 구분 FROM dim_issuer ORDER BY issuer_id', conn,
+                                index_col='issuer_id')
+    return metrics, issuers
+
+
+def fact_query(metric_ids, issuer_ids=None, start=None, end=None, columns='period, metric_id, issuer_id, value'):
+    """SELECT over fact_value for the given ids and inclusive period range. Returns (sql, params)."""
+    where, params = [f'metric_id IN ({", ".join("?" * len(metric_ids))})'], [int(i) for i in metric_ids]
+    if issuer_ids is not None:
+        where.append(f'issuer_id IN ({", ".join("?" * len(issuer_ids))})')
+        params += [int(i) for i in issuer_ids]
+    if start is not None:
+        where.append('period >= ?')
+        params.append(int(start))
+    if end is not None:
+        where.append('period <= ?')
+        params.append(int(end))
+    return f'SELECT {columns} FROM fact_value WHERE {" AND ".join(where)}', params
+
+
+def resolve(conn, issuers=None, **criteria):
+    """
+    Dimension rows matching the criteria: (dim_metric rows, dim_issuer rows or None for all).
+
+    criteria are label columns, e.g. 대분류='회원수' or 중분류=['신규회원수(월중)', '해지회원수(월중)'].
+    """
+    unknown = set(criteria) - set(LABEL_COLUMNS)
+    if unknown:
+        raise ValueError(f'unknown label column(s): {sorted(unknown)}')
+    metrics, issuer_dim = read_dimensions(conn)
+    for col, value in criteria.items():
+        metrics = metrics[metrics[col].isin(as_list(value))]
+    if issuers is not None:
+        issuers = as_list(issuers)
+        # In the requested order
+        issuer_dim = (issuer_dim.reset_index().set_index('구분')
+                                .reindex(issuers).dropna().reset_index()
+                                .astype({'issuer_id': int}).set_index('issuer_id'))
+    return metrics, issuer_dim if issuers is not None else None
+
+
+def stream_facts(conn, metric_ids, issuer_ids=None, start=None, end=None, budget_mb=MEMORY_BUDGET_MB):
+    """fact_value rows matching the filters, as (period, metric_id, issuer_id, value) chunks."""
+    if not len(metric_ids):
+        return
+    sql, params = fact_query(metric_ids, issuer_ids, start, end)
+    for chunk in pd.read_sql_query(sql, conn, params=params, chunksize=chunk_rows(budget_mb)):
+        yield chunk
+
+
+def positions(ids, index):
+    """Position of each id in `index` (an id Index), -1 where absent, via a dense lookup array."""
+    lookup = np.full(int(max(index.max(), ids.max())) + 1, -1)
+    lookup[index.to_numpy()] = np.arange(len(index))
+    return lookup[ids]
+
+
+def load_cube(conn, issuers=None, start=None, end=None, budget_mb=MEMORY_BUDGET_MB, **criteria):
+    """
+    Cube of the fact rows matching the filters, built chunk by chunk.
+
+    The label axis is the matching dim_metric rows (crefia_label.csv order), the
+    issuer axis the requested issuers (default: every issuer with data), in order.
+    """
+    metrics, issuer_dim = resolve(conn, issuers, **criteria)
+    metric_ids = metrics.index.tolist()
+    issuer_ids = None if issuer_dim is None else issuer_dim.index.tolist()
+
+    # The axes first, from the index alone, so the cube's size is known before reading values
+    sql, params = fact_query(metric_ids, issuer_ids, start, end, columns='DISTINCT period, issuer_id')
+    with span('read_axes'):
+        axes = pd.read_sql_query(sql, conn, params=params)
+    periods = pd.Index(np.sort(axes['period'].unique()))
+    if issuer_dim is None:
+        issuer_dim = read_dimensions(conn)[1]
+    issuer_dim = issuer_dim[issuer_dim.index.isin(axes['issuer_id'].unique())]
+
+    shape = (len(periods), len(metrics), len(issuer_dim))
+    nbytes = int(np.prod(shape)) * 8
+    if nbytes > budget_mb * 2**20 * (1 - CHUNK_SHARE):
+        raise MemoryError(f'cube {shape} needs {nbytes / 2**20:.0f}MB, over the {budget_mb}MB budget; '
+                          'narrow the filters or raise CREFIA_MEMORY_BUDGET_MB')
+
+    values = np.full(shape, np.nan)
+    for chunk in stream_facts(conn, metric_ids, issuer_dim.index.tolist(), start, end, budget_mb):
+        with span('scatter', rows=len(chunk)):
+            p = periods.get_indexer(chunk['period'])
+            m = positions(chunk['metric_id'].to_numpy(), metrics.index)
+            i = positions(chunk['issuer_id'].to_numpy(), issuer_dim.index)
+            values[p, m, i] = chunk['value'].to_numpy(dtype=float)
+    return Cube(values, periods.astype(str), metrics[LABEL_COLUMNS], issuer_dim['구분'].to_numpy())
+
+
+def iter_long(conn, issuers=None, start=None, end=None, budget_mb=MEMORY_BUDGET_MB, **criteria):
+    """Matching rows in the master_table layout, one chunk at a time (label columns as categoricals)."""
+    metrics, issuer_dim = resolve(conn, issuers, **criteria)
+    all_issuers = read_dimensions(conn)[1] if issuer_dim is None else issuer_dim
+    issuer_ids = None if issuer_dim is None else issuer_dim.index.tolist()
+    labels = {col: pd.Categorical(metrics[col]) for col in LABEL_COLUMNS}
+    names = pd.Categorical(all_issuers['구분'])
+
+    for chunk in stream_facts(conn, metrics.index.tolist(), issuer_ids, start, end, budget_mb):
+        m = positions(chunk['metric_id'].to_numpy(), metrics.index)
+        i = positions(chunk['issuer_id'].to_numpy(), all_issuers.index)
+        df = pd.DataFrame({'기준년월': chunk['period'].astype(str)})
+        for col, categorical in labels.items():
+            df[col] = pd.Categorical.from_codes(categorical.codes[m], dtype=categorical.dtype)
+        df['구분'] = pd.Categorical.from_codes(names.codes[i], dtype=names.dtype)
+        df['value'] = chunk['value'].to_numpy(dtype=float)
+        yield df
+
+
+def groupby_agg(conn, by, aggs=('sum', 'count'), issuers=None, start=None, end=None,
+                budget_mb=MEMORY_BUDGET_MB, **criteria):
+    """
+    Aggregate `value` by the columns `by` (label columns, 구분, 기준년월) over the matching rows.
+
+    Each chunk is reduced to sum / count / min / max partials per group and the
+    partials are combined as chunks arrive, so only one chunk and one row per
+    group are held. aggs: any of AGGREGATIONS. Returns a DataFrame indexed by `by`.
+    """
+    by = as_list(by)
+    unknown = set(aggs) - set(AGGREGATIONS)
+    if unknown:
+        raise ValueError(f'unsupported aggregation(s): {sorted(unknown)}')
+
+    total = None
+    for df in iter_long(conn, issuers, start, end, budget_mb, **criteria):
+        with span('partial_agg', rows=len(df)):
+            partial = df.groupby(by, observed=True)['value'].agg(['sum', 'count', 'min', 'max'])
+            if total is None:
+                total = partial
+                continue
+            combined = pd.concat([total, partial])
+            grouped = combined.groupby(level=list(range(len(by))))
+            total = pd.DataFrame({
+                'sum': grouped['sum'].sum(),
+                'count': grouped['count'].sum(),
+                'min': grouped['min'].min(),
+                'max': grouped['max'].max(),
+            })
+    if total is None:
+        total = pd.DataFrame(columns=['sum', 'count', 'min', 'max'])
+    total['mean'] = total['sum'] / total['count'].where(total['count'] > 0)
+    return total[list(aggs)]